@@ -0,0 +1,244 @@
+import socket, sys
+import os
+import time
+import json
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+import multiprocessing
+
+# Load-test harness for vodserver.py: starts the server on a loopback port in
+# a scratch directory filled with synthetic content, drives concurrent
+# keep-alive clients with a mix of full GETs, random Range requests and 404
+# probes, and prints a JSON report. Runs are reproducible for a given --seed.
+#
+# usage: python vodbench.py --clients 32 --duration 10 --mode select
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vodserver.py")
+
+DEFAULT_SIZES = "1k:20,64k:10,1m:4,16m:2"
+DEFAULT_MIX = "full:60,range:30,404:10"
+
+def parse_size(text):
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    text = text.strip().lower()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def parse_weights(text, convert=str):
+    # "a:3,b:1" -> [(a, 3), (b, 1)]
+    weights = []
+    for item in text.split(','):
+        key, _, weight = item.partition(':')
+        weights.append((convert(key), int(weight or 1)))
+    return weights
+
+def generate_content(root, sizes, seed):
+    # synthetic files, same bytes for the same seed
+    content_dir = os.path.join(root, "content")
+    os.makedirs(content_dir, exist_ok=True)
+    rng = random.Random(seed)
+    objects = []
+    for size, count in sizes:
+        for i in range(count):
+            name = f"obj_{size}_{i}.bin"
+            with open(os.path.join(content_dir, name), 'wb') as f:
+                remaining = size
+                while remaining > 0:
+                    block = min(remaining, 1048576)
+                    f.write(rng.randbytes(block))
+                    remaining -= block
+            objects.append(("/" + name, size))
+    return objects
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(root, port, mode, workers, processes):
+    server = subprocess.Popen([sys.executable, SERVER_SCRIPT, str(port), mode, str(workers), str(processes)],
+                              cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"server exited with code {server.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("server did not start listening")
+
+def run_client(port, objects, mix, seed, stop_at, keep_alive, results):
+    # one client: its own connection, its own seeded request sequence
+    rng = random.Random(seed)
+    kinds = [kind for kind, _ in mix]
+    weights = [weight for _, weight in mix]
+    connection = None
+    latencies = []
+    statuses = {}
+    errors = 0
+    received = 0
+
+    while time.time() < stop_at:
+        kind = rng.choices(kinds, weights)[0]
+        path, size = rng.choice(objects)
+        headers = {}
+        if kind == "404":
+            path = f"/missing_{rng.randrange(1 << 30)}.bin"
+        elif kind == "range" and size > 1:
+            start = rng.randrange(size)
+            end = min(size - 1, start + rng.randrange(1, 1048576))
+            headers['Range'] = f"bytes={start}-{end}"
+        if not keep_alive:
+            headers['Connection'] = "close"
+
+        started = time.perf_counter()
+        try:
+            if connection is None:
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+            received += len(body)
+            if response.will_close:
+                connection.close()
+                connection = None
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            if connection is not None:
+                connection.close()
+            connection = None
+
+    if connection is not None:
+        connection.close()
+    results.append((latencies, statuses, errors, received))
+
+def run_client_process(port, objects, mix, seeds, stop_at, keep_alive):
+    # a group of client threads inside one process, so the load generator
+    # itself isn't limited to one core
+    results = []
+    threads = [threading.Thread(target=run_client,
+                                args=(port, objects, mix, seed, stop_at, keep_alive, results))
+               for seed in seeds]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+def benchmark(args):
+    sizes = parse_weights(args.sizes, parse_size)
+    mix = parse_weights(args.mix)
+
+    with tempfile.TemporaryDirectory(prefix="vodbench-") as root:
+        objects = generate_content(root, sizes, args.seed)
+        port = args.port or free_port()
+        server = start_server(root, port, args.mode, args.workers, args.server_processes)
+        try:
+            # one full warm-up pass so every run starts from the same cache state
+            for path, size in objects:
+                warm = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                warm.request("GET", path)
+                warm.getresponse().read()
+                warm.close()
+
+            seeds = [args.seed * 1000003 + i for i in range(args.clients)]
+            processes = max(1, min(args.processes, args.clients))
+            groups = [seeds[i::processes] for i in range(processes)]
+            started = time.time()
+            stop_at = started + args.duration
+            with multiprocessing.Pool(processes) as pool:
+                group_results = pool.starmap(run_client_process,
+                                             [(port, objects, mix, group, stop_at, not args.no_keepalive)
+                                              for group in groups])
+            elapsed = time.time() - started
+        finally:
+            server.terminate()
+            try:
+                server.wait(5)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+    latencies = []
+    statuses = {}
+    errors = 0
+    received = 0
+    for results in group_results:
+        for client_latencies, client_statuses, client_errors, client_received in results:
+            latencies.extend(client_latencies)
+            for status, count in client_statuses.items():
+                statuses[str(status)] = statuses.get(str(status), 0) + count
+            errors += client_errors
+            received += client_received
+    latencies.sort()
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        "config": {
+            "mode": args.mode,
+            "workers": args.workers,
+            "server_processes": args.server_processes,
+            "clients": args.clients,
+            "processes": processes,
+            "duration": args.duration,
+            "keep_alive": not args.no_keepalive,
+            "sizes": args.sizes,
+            "mix": args.mix,
+            "seed": args.seed,
+        },
+        "requests": len(latencies),
+        "errors": errors,
+        "status": statuses,
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "throughput_mib_per_second": round(received / elapsed / 1048576, 2),
+        "latency_ms": {
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": ms(percentile(latencies, 0.50)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "p999": ms(percentile(latencies, 0.999)),
+            "max": ms(latencies[-1]) if latencies else None,
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test vodserver.py on a loopback port.")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument("--mode", default="thread", choices=("thread", "select", "asyncio"), help="server concurrency mode")
+    parser.add_argument("--workers", type=int, default=32, help="server worker threads")
+    parser.add_argument("--server-processes", type=int, default=1, help="pre-fork server processes")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="synthetic files as size:count,... (k/m/g suffixes)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="request mix as full:w,range:w,404:w")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="client processes")
+    parser.add_argument("--no-keepalive", action="store_true", help="new connection for every request")
+    parser.add_argument("--seed", type=int, default=1, help="seed for content and request sequences")
+    parser.add_argument("--port", type=int, default=0, help="server port (default: a free one)")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = benchmark(args)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
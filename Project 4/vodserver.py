@@ -1,336 +1,3823 @@
 import socket, sys
 import datetime
 import os
+import time
+import threading
+import queue
+import selectors
+import select
+import collections
+import mmap
+import struct
+import ctypes, ctypes.util
+import concurrent.futures
+import asyncio
+import signal
+import pickle
+import gc
+import resource
 
 import urllib.parse
+import http.client
+import hashlib
+import shutil
 import mimetypes
+import email.utils
+import gzip
+import bisect
+import heapq
+import itertools
+import logging, logging.handlers
+import json
+import math
+
+try:
+    import brotli   # optional, only used for on-the-fly br encoding
+except ImportError:
+    brotli = None
 
 BUFSIZE = 1024
-LARGEST_CONTENT_SIZE = 5242880
+LARGEST_CONTENT_SIZE = None   # optional cap on servable file size in bytes, None = no limit
+USE_SENDFILE = True           # zero-copy body delivery, False forces the buffered path
+SEND_CHUNK_SIZE = 262144      # read size for the buffered fallback
+
+CACHE_MAX_BYTES = 67108864        # memory budget of the hot-content cache, 0 disables it
+CACHE_MAX_OBJECT_SIZE = 262144    # only files up to this size are kept in memory
+CACHE_REVALIDATE_INTERVAL = 1.0   # seconds between mtime checks of a cached file
+
+MMAP_RANGES = True            # serve 206 bodies of large files from shared mappings
+MMAP_IDLE_TIMEOUT = 30.0      # seconds an unused mapping stays open
+MMAP_MAX_MAPPINGS = 256       # beyond this many open mappings ranges fall back to sendfile
+
+MAX_RANGE_COUNT = 32          # Range headers with more specs than this are ignored (full 200)
+RANGE_COALESCE_GAP = 80       # ranges closer than this are merged, roughly one multipart header
+
+CACHE_CONTROL = "public, max-age=3600"   # Cache-Control sent with content, None to omit
+CACHE_CONTROL_BY_TYPE = {
+    # playlists change while a title is being packaged, make clients revalidate
+    'application/vnd.apple.mpegurl': "no-cache",
+    'application/x-mpegurl': "no-cache",
+    'application/dash+xml': "no-cache",
+}
+
+SEGMENTS = True               # serve /_segments/<file>/index.m3u8 playlists and their segments (MPEG-TS files only)
+SEGMENT_PREFIX = "/_segments/"
+SEGMENT_DURATION = 6.0        # target segment length in seconds
+SEGMENT_SIZE = 2097152        # segment size for MPEG-TS files without a usable PCR clock
+SEGMENT_ASSUMED_BITRATE = 4000000   # bits/s used to estimate durations of those fixed-size segments
+SEGMENT_MIN_DURATION = 0.001        # floor for a segment's duration, a few trailing bytes still take some time
+SEGMENT_SEARCH_WINDOW = 262144      # bytes scanned after a nominal boundary for a keyframe / PCR
+SEGMENT_INDEX_SUFFIX = ".segidx"    # sidecar next to the media file caching its segment table
+TS_EXTENSIONS = ('.ts', '.m2ts', '.mts')
+TS_PACKET_SIZE = 188
+
+INDEX_IGNORE_SUFFIXES = (SEGMENT_INDEX_SUFFIX,)   # server-generated sidecars, never served
+
+INDEX_LAZY_STARTUP = True     # build the content index in the background, stat() on misses until it is ready
+INDEX_SCAN_THREADS = 8        # parallel directory scanners for full index builds
+INDEX_USE_INOTIFY = True      # follow changes with Linux inotify when it is available
+INDEX_POLL_INTERVAL = 2.0     # seconds between rescans when inotify isn't used, 0 disables refresh
+INDEX_BATCH_DELAY = 0.05      # inotify events arriving this close together are applied as one update
+
+COMPRESSION = True            # negotiate Content-Encoding for text-like content
+COMPRESS_MIN_SIZE = 256       # smaller bodies aren't worth a Content-Encoding header
+COMPRESS_MAX_SIZE = 4194304   # largest file compressed on the fly (sidecars have no limit)
+COMPRESS_LEVEL = 6
+COMPRESS_CACHE_BYTES = 16777216   # memory budget for on-the-fly compressed bodies
+COMPRESSIBLE_TYPES = {
+    'application/javascript', 'application/json', 'application/xml', 'image/svg+xml',
+    'application/vnd.apple.mpegurl', 'application/x-mpegurl', 'application/dash+xml',
+}
+ENCODING_SUFFIXES = (('br', '.br'), ('gzip', '.gz'))   # preferred first
+
+CONCURRENCY_MODE = "thread"   # "thread" = bounded worker pool (idle keep-alive parked in a select loop), "select" = selectors event loop + worker pool,
+                              # "asyncio" = one coroutine per connection, handlers on a small thread pool
+WORKER_COUNT = 32             # number of worker threads serving requests
+ACCEPT_BACKLOG = 10000        # listen() backlog for pending connections
+ACCEPT_ERROR_DELAY = 0.1      # seconds the accept loop pauses after accept() fails (e.g. out of file descriptors)
+
+ORIGIN = None                 # "http://host:port" to pull files missing from the content dir from (edge cache mode)
+ORIGIN_CACHE_DIR = "cache"    # where pulled files are kept
+ORIGIN_CACHE_MAX_BYTES = 10737418240   # disk budget of the edge cache, least recently used files go first
+ORIGIN_CACHE_TTL = 60.0       # seconds a pulled file is served before it is revalidated with the origin
+ORIGIN_TIMEOUT = 10.0         # connect / read timeout towards the origin
+ORIGIN_SLICE_SIZE = 1048576   # larger files are cached in slices of this size fetched on demand, 0 = whole files only
+ORIGIN_SLICE_READAHEAD = 2    # slices fetched ahead of the one being sent
+
+PREFORK_PROCESSES = 1         # >1 runs a supervisor plus this many server processes on the port
+PREFORK_REUSEPORT = True      # each process binds its own SO_REUSEPORT socket, False = share one listening socket
+PREFORK_RESPAWN_DELAY = 1.0   # minimum seconds between respawns of a crashing worker process
+SHUTDOWN_GRACE = 30.0         # seconds in-flight requests get to finish on SIGTERM / reload
+
+KEEPALIVE_TIMEOUT = 5         # seconds an idle keep-alive connection stays open
+KEEPALIVE_MAX_REQUESTS = 100  # requests served on one connection before it is closed
+
+HEADER_TIMEOUT = 10.0         # seconds from the first byte of a request to the end of its headers
+SEND_TIMEOUT = 30.0           # seconds a response write may stall before the client is dropped
+MAX_HEADER_SIZE = 16384       # request line + headers, larger requests get 431
+MAX_CONNECTIONS = None        # open connections per server process, 0 = unlimited, None = what RLIMIT_NOFILE
+                              # leaves after FD_HEADROOM, a file per worker and the mmap pool
+MAX_CONNECTIONS_PER_IP = None # open connections from one client IP per server process, 0 = unlimited,
+                              # None = half the workers, so one client can't take them all
+FD_HEADROOM = 64              # descriptors kept for the listening socket, logs, the index, pipes and sidecars
+SHED_LOAD = True              # answer 503 right away when the workers are saturated instead of queueing
+RETRY_AFTER = 1               # seconds suggested to clients turned away with 503
+
+SHAPING_CONNECTION_RATE = 0   # bytes/s per connection, 0 = unlimited
+SHAPING_IP_RATE = 0           # bytes/s shared by all connections from one client IP, 0 = unlimited
+SHAPING_GLOBAL_RATE = 0       # total egress bytes/s shared fairly between streams, 0 = unlimited
+SHAPING_IP_WEIGHTS = {}       # client IP -> weight in the global round robin (default 1)
+SHAPING_CHUNK = 65536         # largest single send while shaping
+SHAPING_QUANTUM = 65536       # bytes a weight-1 stream may send per round robin turn
+STREAMS_PATH = "/_streams"    # JSON list of connections and their current send rates
+STREAMS_ALLOWED_IPS = ("127.0.0.1",)   # clients that may read it (it shows every client's IP and path), () = nobody
+
+LISTING_PATH = "/_list"       # JSON listing: ?prefix=&sort=path|size|mtime&order=asc|desc&type=&limit=&cursor=
+LISTING_DEFAULT_LIMIT = 100
+LISTING_MAX_LIMIT = 1000
+LISTING_SORT_WINDOW = 50000   # prefixes with up to this many files are sorted directly, larger ones walk the global order
+
+METRICS_PATH = "/_metrics"    # Prometheus text-format metrics
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LOG_LEVEL = "INFO"            # DEBUG logs every connection and request
+LOG_QUEUE_SIZE = 10000        # log records buffered for the writer thread, extra ones are dropped
+
+SERVER_HEADER = b"Server: Simple-File-Server/1.0\r\n"
+CONNECTION_CLOSE = b"Connection: close\r\n"
+CONNECTION_KEEP_ALIVE = f"Connection: keep-alive\r\nKeep-Alive: timeout={KEEPALIVE_TIMEOUT}\r\n".encode()
+
+STATUS_REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    304: "Not Modified",
+    403: "Forbidden",
+    404: "Not Found",
+    416: "Range Not Satisfiable",
+    415: "Unsupported Media Type",
+    431: "Request Header Fields Too Large",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+}
+
+NOT_FOUND_BODY = b"""<!DOCTYPE html>
+<html>
+<head><title>404 Not Found</title></head>
+<body><h1>404 Not Found</h1><p>The requested resource was not found on this server.</p></body>
+</html>"""
+
+FORBIDDEN_BODY = b"""<!DOCTYPE html>
+<html>
+<head><title>403 Forbidden</title></head>
+<body><h1>403 Forbidden</h1><p>Access to this resource is forbidden.</p></body>
+</html>"""
+
+BAD_GATEWAY_BODY = b"""<!DOCTYPE html>
+<html>
+<head><title>502 Bad Gateway</title></head>
+<body><h1>502 Bad Gateway</h1><p>The origin server could not be reached.</p></body>
+</html>"""
+
+UNSUPPORTED_MEDIA_BODY = b"""<!DOCTYPE html>
+<html>
+<head><title>415 Unsupported Media Type</title></head>
+<body><h1>415 Unsupported Media Type</h1><p>Only MPEG-TS files can be played as segments.</p></body>
+</html>"""
+
+HEADERS_TOO_LARGE_BODY = b"""<!DOCTYPE html>
+<html>
+<head><title>431 Request Header Fields Too Large</title></head>
+<body><h1>431 Request Header Fields Too Large</h1><p>The request headers are too large.</p></body>
+</html>"""
+
+UNAVAILABLE_BODY = b"""<!DOCTYPE html>
+<html>
+<head><title>503 Service Unavailable</title></head>
+<body><h1>503 Service Unavailable</h1><p>The server is busy, please try again shortly.</p></body>
+</html>"""
+
+log = logging.getLogger("vodserver")
+
+class Drop_Queue_Handler(logging.handlers.QueueHandler):
+    # hands records to the writer thread; if it falls behind, records are
+    # dropped (and counted) instead of blocking request threads
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging(level=LOG_LEVEL):
+    # route the server's log through a bounded queue to one writer thread so
+    # request threads never wait on stdout. Returns the listener to stop on
+    # shutdown, or None if logging was already set up.
+    if log.handlers:
+        return None
+    log.setLevel(level)
+    log.propagate = False
+    handler = Drop_Queue_Handler(queue.Queue(LOG_QUEUE_SIZE))
+    log.addHandler(handler)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(handler.queue, output)
+    listener.start()
+    return listener
+
+class Latency_Histogram():
+    # fixed-bucket histogram, rendered as a Prometheus histogram
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # caller holds the metrics lock
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, help_text):
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum:.6f}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+class Server_Metrics():
+    # request counters and latency histograms behind METRICS_PATH
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses = {status: 0 for status in STATUS_REASONS}
+        self.bytes_sent = 0
+        self.connections = 0
+        self.rejected = {}        # reason -> connections turned away or dropped early
+        self.time_to_first_byte = Latency_Histogram()
+        self.request_duration = Latency_Histogram()
+
+    def connection_accepted(self):
+        with self.lock:
+            self.connections += 1
+
+    def connection_rejected(self, reason):
+        with self.lock:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+
+    def observe(self, status, bytes_sent, time_to_first_byte, duration):
+        with self.lock:
+            self.responses[status] = self.responses.get(status, 0) + 1
+            self.bytes_sent += bytes_sent
+            if time_to_first_byte is not None:
+                self.time_to_first_byte.observe(time_to_first_byte)
+            self.request_duration.observe(duration)
+
+    def render(self, server):
+        cache = server.content_cache.stats()
+        with self.lock:
+            lines = ["# HELP vod_responses_total Responses sent, by status code.",
+                     "# TYPE vod_responses_total counter"]
+            for status, count in sorted(self.responses.items()):
+                lines.append(f'vod_responses_total{{code="{status}"}} {count}')
+            lines += [
+                "# HELP vod_bytes_sent_total Bytes written to clients, headers included.",
+                "# TYPE vod_bytes_sent_total counter",
+                f"vod_bytes_sent_total {self.bytes_sent}",
+                "# HELP vod_connections_total Connections accepted.",
+                "# TYPE vod_connections_total counter",
+                f"vod_connections_total {self.connections}",
+                "# HELP vod_connections_rejected_total Connections refused or dropped by admission control and deadlines.",
+                "# TYPE vod_connections_rejected_total counter",
+            ]
+            for reason, count in sorted(self.rejected.items()):
+                lines.append(f'vod_connections_rejected_total{{reason="{reason}"}} {count}')
+            lines += self.time_to_first_byte.render("vod_time_to_first_byte_seconds",
+                                                    "Time from a complete request to its first response byte.")
+            lines += self.request_duration.render("vod_request_duration_seconds",
+                                                  "Time from a complete request to its last response byte.")
+        lines += [
+            "# HELP vod_active_connections Open client connections.",
+            "# TYPE vod_active_connections gauge",
+            f"vod_active_connections {len(server.traffic_shaper.streams)}",
+            "# HELP vod_indexed_files Files in the content index.",
+            "# TYPE vod_indexed_files gauge",
+            f"vod_indexed_files {len(server.content_list)}",
+            "# HELP vod_content_cache_hits_total Content cache hits.",
+            "# TYPE vod_content_cache_hits_total counter",
+            f"vod_content_cache_hits_total {cache['hits']}",
+            "# HELP vod_content_cache_misses_total Content cache misses.",
+            "# TYPE vod_content_cache_misses_total counter",
+            f"vod_content_cache_misses_total {cache['misses']}",
+            "# HELP vod_content_cache_bytes Bytes held by the content cache.",
+            "# TYPE vod_content_cache_bytes gauge",
+            f"vod_content_cache_bytes {cache['bytes']}",
+            "# HELP vod_mmap_mappings Open shared file mappings.",
+            "# TYPE vod_mmap_mappings gauge",
+            f"vod_mmap_mappings {len(server.mmap_pool.mappings)}",
+        ]
+        if server.origin_cache is not None:
+            origin = server.origin_cache.stats()
+            lines += [
+                "# HELP vod_origin_cache_hits_total Requests answered from the edge cache.",
+                "# TYPE vod_origin_cache_hits_total counter",
+                f"vod_origin_cache_hits_total {origin['hits']}",
+                "# HELP vod_origin_fetches_total Fetches started towards the origin.",
+                "# TYPE vod_origin_fetches_total counter",
+                f"vod_origin_fetches_total {origin['fetches']}",
+                "# HELP vod_origin_cache_bytes Bytes stored in the edge cache.",
+                "# TYPE vod_origin_cache_bytes gauge",
+                f"vod_origin_cache_bytes {origin['bytes']}",
+            ]
+        lines += [
+            "# HELP vod_log_records_dropped_total Log records dropped because the writer fell behind.",
+            "# TYPE vod_log_records_dropped_total counter",
+            f"vod_log_records_dropped_total {sum(getattr(h, 'dropped', 0) for h in log.handlers)}",
+        ]
+        return ("\n".join(lines) + "\n").encode()
+
+class Token_Bucket():
+    # classic token bucket. reserve() always succeeds but may leave the bucket
+    # in debt; the caller sleeps for the returned time before sending.
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, SHAPING_CHUNK)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+class Connection_Limiter():
+    # admission control: open connections in total and per client IP. The
+    # accept loops ask admit() first; Client_Connection gives the slot back
+    # when it closes. 0 means no limit (the server derives the defaults,
+    # see Vod_Server.connection_limits).
+    def __init__(self, max_connections=0, max_per_ip=0):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.total = 0
+        self.per_ip = {}
+        self.lock = threading.Lock()
+
+    def admit(self, ip):
+        # None if the connection may proceed, otherwise the reason it may not
+        with self.lock:
+            if self.max_connections > 0 and self.total >= self.max_connections:
+                return "overload"
+            count = self.per_ip.get(ip, 0)
+            if self.max_per_ip > 0 and count >= self.max_per_ip:
+                return "per_ip"
+            self.total += 1
+            self.per_ip[ip] = count + 1
+            return None
+
+    def release(self, ip):
+        with self.lock:
+            self.total -= 1
+            count = self.per_ip.get(ip, 0) - 1
+            if count > 0:
+                self.per_ip[ip] = count
+            else:
+                self.per_ip.pop(ip, None)
+
+class Traffic_Shaper():
+    # egress control for every client connection: an optional token bucket per
+    # connection and per client IP, plus a global bucket whose bandwidth is
+    # handed out with weighted deficit round robin, so under overload every
+    # active stream gets its share instead of whoever sends fastest.
+    # Also keeps a per-connection send rate for STREAMS_PATH.
+    def __init__(self, connection_rate=SHAPING_CONNECTION_RATE, ip_rate=SHAPING_IP_RATE,
+                 global_rate=SHAPING_GLOBAL_RATE, ip_weights=SHAPING_IP_WEIGHTS):
+        self.connection_rate = connection_rate
+        self.ip_rate = ip_rate
+        self.ip_weights = ip_weights
+        self.global_bucket = Token_Bucket(global_rate) if global_rate > 0 else None
+        self.limited = connection_rate > 0 or ip_rate > 0 or global_rate > 0
+
+        self.lock = threading.Lock()
+        self.streams = set()
+        self.ip_buckets = {}       # ip -> [Token_Bucket, connection count]
+
+        # deficit round robin over the streams waiting for global bandwidth
+        self.turn = threading.Condition()
+        self.waiting = collections.deque()
+
+    def register(self, connection):
+        ip = connection.address[0]
+        connection.bucket = Token_Bucket(self.connection_rate) if self.connection_rate > 0 else None
+        connection.weight = self.ip_weights.get(ip, 1)
+        with self.lock:
+            self.streams.add(connection)
+            if self.ip_rate > 0:
+                shared = self.ip_buckets.setdefault(ip, [Token_Bucket(self.ip_rate), 0])
+                shared[1] += 1
+                connection.ip_bucket = shared[0]
+            else:
+                connection.ip_bucket = None
+
+    def unregister(self, connection):
+        ip = connection.address[0]
+        with self.lock:
+            if connection not in self.streams:
+                return
+            self.streams.discard(connection)
+            shared = self.ip_buckets.get(ip)
+            if shared is not None:
+                shared[1] -= 1
+                if shared[1] == 0:
+                    del self.ip_buckets[ip]
+
+    def throttle(self, connection, amount):
+        # block until connection may send amount bytes
+        delay = self.local_delay(connection, amount)
+        if delay > 0:
+            time.sleep(delay)
+        if self.global_bucket is not None:
+            self.schedule(connection, amount)
+
+    def reserve(self, connection, amount):
+        # non-blocking variant for the asyncio loop: seconds to wait before
+        # sending amount bytes. The global bucket is taken first come first
+        # served here; coroutines reserve one chunk at a time so streams still
+        # interleave evenly, but weights aren't applied.
+        delay = self.local_delay(connection, amount)
+        if self.global_bucket is not None:
+            delay = max(delay, self.global_bucket.reserve(amount))
+        return delay
+
+    def local_delay(self, connection, amount):
+        delay = 0.0
+        if connection.bucket is not None:
+            delay = connection.bucket.reserve(amount)
+        if connection.ip_bucket is not None:
+            delay = max(delay, connection.ip_bucket.reserve(amount))
+        return delay
+
+    def schedule(self, connection, amount):
+        with self.turn:
+            self.waiting.append(connection)
+            while True:
+                if self.waiting[0] is connection:
+                    if connection.deficit >= amount:
+                        break
+                    # out of credit for this round: top up and go to the back
+                    connection.deficit += SHAPING_QUANTUM * connection.weight
+                    self.waiting.rotate(-1)
+                    self.turn.notify_all()
+                    if len(self.waiting) == 1:
+                        continue
+                self.turn.wait()
+            connection.deficit -= amount
+            delay = self.global_bucket.reserve(amount)
+            self.waiting.popleft()
+            self.turn.notify_all()
+        if delay > 0:
+            time.sleep(delay)
+
+    def stream_rates(self):
+        with self.lock:
+            streams = list(self.streams)
+        now = time.monotonic()
+        rates = []
+        for connection in streams:
+            rates.append({
+                "client": f"{connection.address[0]}:{connection.address[1]}",
+                "path": connection.request_path,
+                "bytes_sent": connection.bytes_sent,
+                "rate": connection.current_rate(now),
+                "weight": connection.weight,
+            })
+        return rates
+
+class Client_Connection():
+    # a client socket plus the state it needs between keep-alive requests
+    def __init__(self, connection_socket, client_address, shaper=None, limiter=None):
+        self.socket = connection_socket
+        self.address = client_address
+        self.shaper = shaper
+        self.limiter = limiter    # Connection_Limiter that admitted us, released on close
+        self.request_path = ''
+        self.status = None        # status code of the response being sent
+        self.first_byte_at = None
+        self.bytes_sent = 0
+        self.deficit = 0
+        self.rate_window_start = time.monotonic()
+        self.rate_window_bytes = 0
+        self.rate = 0.0
+        if shaper is not None:
+            shaper.register(self)
+        # request bytes are received into one reusable chunk and appended to a
+        # bytearray, consumed requests are deleted from its front
+        self.buffer = bytearray()
+        self.chunk = memoryview(bytearray(BUFSIZE))
+        self.scanned = 0          # buffer prefix already searched for the end of headers
+        self.requests_served = 0
+        self.keep_alive = False
+        self.body_remaining = 0   # request body bytes still to be skipped
+        self.last_active = time.monotonic()
+        self.header_started = None  # when the first byte of the request being read arrived
+        self.timeout = None       # socket timeout currently set
+        self.slice_cursor = None  # (url path, slice) where the last edge-cache read ended
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def send(self, data):
+        sent = self.socket.send(data)
+        self.record_sent(sent)
+        return sent
+
+    def sendall(self, data):
+        if self.shaper is None or not self.shaper.limited:
+            self.socket.sendall(data)
+            self.record_sent(len(data))
+            return
+        view = memoryview(data)
+        for start in range(0, len(view), SHAPING_CHUNK):
+            piece = view[start:start + SHAPING_CHUNK]
+            self.shaper.throttle(self, len(piece))
+            self.socket.sendall(piece)
+            self.record_sent(len(piece))
+
+    def sendfile(self, file, offset, count):
+        if self.shaper is None or not self.shaper.limited:
+            sent = self.socket.sendfile(file, offset, count)
+            self.record_sent(sent)
+            return sent
+        sent = 0
+        while sent < count:
+            piece = min(SHAPING_CHUNK, count - sent)
+            self.shaper.throttle(self, piece)
+            done = self.socket.sendfile(file, offset + sent, piece)
+            self.record_sent(done)
+            sent += done
+            if done < piece:
+                break
+        return sent
+
+    def record_sent(self, amount):
+        # bytes counter plus a rate measured over roughly one-second windows
+        if self.first_byte_at is None:
+            self.first_byte_at = time.perf_counter()
+        self.bytes_sent += amount
+        self.rate_window_bytes += amount
+        now = time.monotonic()
+        elapsed = now - self.rate_window_start
+        if elapsed >= 1.0:
+            self.rate = self.rate_window_bytes / elapsed
+            self.rate_window_start = now
+            self.rate_window_bytes = 0
+
+    def current_rate(self, now):
+        elapsed = now - self.rate_window_start
+        if elapsed >= 2.0:
+            # nothing sent for a while
+            return 0.0
+        if elapsed >= 1.0:
+            return self.rate_window_bytes / elapsed
+        return self.rate
+
+    def recv_more(self):
+        # read whatever the client sent next into the buffer, returns False on EOF
+        return self.add_received(self.socket.recv_into(self.chunk))
+
+    def add_received(self, received):
+        self.buffer += self.chunk[:received]
+        self.last_active = time.monotonic()
+        if received and self.header_started is None:
+            self.header_started = self.last_active
+        return received > 0
+
+    def read_timeout(self):
+        # how long the next read may wait: the keep-alive idle time, cut short
+        # by the header deadline once a request has started to arrive, so a
+        # client trickling bytes can't hold the connection indefinitely
+        if self.header_started is None:
+            return KEEPALIVE_TIMEOUT
+        return min(KEEPALIVE_TIMEOUT, self.header_started + HEADER_TIMEOUT - time.monotonic())
+
+    def header_expired(self, now):
+        return self.header_started is not None and now - self.header_started > HEADER_TIMEOUT
+
+    def header_too_large(self):
+        # only meaningful after next_request() found no complete request
+        return not self.body_remaining and len(self.buffer) > MAX_HEADER_SIZE
+
+    def set_timeout(self, timeout):
+        if timeout != self.timeout:
+            self.socket.settimeout(timeout)
+            self.timeout = timeout
+
+    def next_request(self):
+        # pop one complete request head off the buffer, None if it hasn't fully arrived
+        if self.body_remaining:
+            skipped = min(self.body_remaining, len(self.buffer))
+            del self.buffer[:skipped]
+            self.body_remaining -= skipped
+            if self.body_remaining:
+                return None
+
+        # only search the bytes that arrived since the last call
+        end = self.buffer.find(b"\r\n\r\n", max(0, self.scanned - 3))
+        if end == -1:
+            self.scanned = len(self.buffer)
+            return None
+        request = bytes(self.buffer[:end + 4])
+        del self.buffer[:end + 4]
+        self.scanned = 0
+        # a pipelined request may already have started arriving
+        self.header_started = time.monotonic() if self.buffer else None
+        return request
+
+    def close(self):
+        if self.shaper is not None:
+            self.shaper.unregister(self)
+        if self.limiter is not None:
+            self.limiter.release(self.address[0])
+            self.limiter = None
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+class Async_Connection(Client_Connection):
+    # client connection of the asyncio server. The handler runs on a worker
+    # thread and must not block on the socket, so its writes are queued here
+    # (bytes, or a dup of the file plus a range) and flush() sends them from
+    # the event loop with sock_sendall / sock_sendfile.
+    def __init__(self, connection_socket, client_address, shaper=None, limiter=None):
+        super().__init__(connection_socket, client_address, shaper, limiter)
+        self.output = []
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def sendall(self, data):
+        self.output.append(bytes(data))
+
+    def sendfile(self, file, offset, count):
+        # the handler closes its file when it returns, keep our own descriptor
+        self.output.append((os.fdopen(os.dup(file.fileno()), 'rb'), offset, count))
+        return count
+
+    async def flush(self, loop):
+        output, self.output = self.output, []
+        if output and self.first_byte_at is None:
+            self.first_byte_at = time.perf_counter()
+        try:
+            for item in output:
+                if isinstance(item, tuple):
+                    await self.send_file_async(loop, *item)
+                else:
+                    await self.sendall_async(loop, item)
+        finally:
+            for item in output:
+                if isinstance(item, tuple):
+                    item[0].close()
+
+    async def sendall_async(self, loop, data):
+        # every piece must go out within SEND_TIMEOUT, so a client that stops
+        # reading is dropped instead of pinning its buffers
+        shaped = self.shaper is not None and self.shaper.limited
+        piece_size = SHAPING_CHUNK if shaped else SEND_CHUNK_SIZE
+        view = memoryview(data)
+        for start in range(0, len(view), piece_size):
+            piece = view[start:start + piece_size]
+            if shaped:
+                await self.throttle_async(len(piece))
+            await asyncio.wait_for(loop.sock_sendall(self.socket, piece), SEND_TIMEOUT)
+            self.record_sent(len(piece))
+
+    async def send_file_async(self, loop, file, offset, count):
+        native = USE_SENDFILE and hasattr(os, 'sendfile')
+        shaped = self.shaper is not None and self.shaper.limited
+        piece_size = SHAPING_CHUNK if shaped else SEND_CHUNK_SIZE
+        sent = 0
+        while sent < count:
+            piece = min(piece_size, count - sent)
+            if shaped:
+                await self.throttle_async(piece)
+            if native:
+                done = await asyncio.wait_for(loop.sock_sendfile(self.socket, file, offset + sent, piece),
+                                              SEND_TIMEOUT)
+            else:
+                data = await loop.run_in_executor(None, os.pread, file.fileno(), piece, offset + sent)
+                await asyncio.wait_for(loop.sock_sendall(self.socket, data), SEND_TIMEOUT)
+                done = len(data)
+            self.record_sent(done)
+            if done < piece:
+                raise OSError(f"File ended {count - sent - done} bytes early")
+            sent += done
+
+    async def throttle_async(self, amount):
+        delay = self.shaper.reserve(self, amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def close(self):
+        for item in self.output:
+            if isinstance(item, tuple):
+                item[0].close()
+        self.output = []
+        super().close()
+
+class Content_Cache():
+    # byte-budgeted LRU cache of small file bodies (index pages, manifests, init
+    # segments) keyed by file path. A cached entry is re-checked against the
+    # file's mtime and size at most once per revalidate interval.
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, max_object_size=CACHE_MAX_OBJECT_SIZE,
+                 revalidate_interval=CACHE_REVALIDATE_INTERVAL):
+        self.max_bytes = max_bytes
+        self.max_object_size = min(max_object_size, max_bytes)
+        self.revalidate_interval = revalidate_interval
+        self.entries = collections.OrderedDict()  # path -> [data, mtime_ns, last_checked]
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, path, mtime_ns=None, size=None):
+        # returns the file contents, or None if the file is too big to cache.
+        # mtime_ns and size are what the content index last saw; if the mtime
+        # disagrees with the cached copy the file is re-checked right away, and
+        # a file indexed as too big is turned away without a stat or a miss
+        if self.max_bytes <= 0 or (size is not None and size > self.max_object_size):
+            return None
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(path)
+            if (entry is not None and now - entry[2] < self.revalidate_interval
+                    and (mtime_ns is None or entry[1] == mtime_ns)):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[0]
+
+        file_stat = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                if entry[1] == file_stat.st_mtime_ns and len(entry[0]) == file_stat.st_size:
+                    entry[2] = now
+                    self.entries.move_to_end(path)
+                    self.hits += 1
+                    return entry[0]
+                # file changed on disk since we cached it
+                self.remove_entry(path)
+                self.invalidations += 1
+            self.misses += 1
+
+        if file_stat.st_size > self.max_object_size:
+            return None
+
+        with open(path, 'rb') as f:
+            data = f.read(self.max_object_size + 1)
+            mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+        if len(data) > self.max_object_size:
+            # grew while we were reading it
+            return None
+
+        self.store(path, data, mtime_ns)
+        return data
+
+    def lookup(self, key, mtime_ns):
+        # cached data derived from a file (e.g. a compressed body), valid only
+        # for the file version with this mtime. No filesystem access.
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == mtime_ns:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self.remove_entry(key)
+                self.invalidations += 1
+            self.misses += 1
+        return None
+
+    def store(self, key, data, mtime_ns):
+        if len(data) > self.max_object_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove_entry(key)
+            self.entries[key] = [data, mtime_ns, time.monotonic()]
+            self.current_bytes += len(data)
+            while self.current_bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self.remove_entry(oldest)
+                self.evictions += 1
+
+    def remove_entry(self, path):
+        # caller holds the lock
+        entry = self.entries.pop(path)
+        self.current_bytes -= len(entry[0])
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+            }
+
+class Mmap_Lease():
+    # one request's hold on a shared mapping, close() hands it back to the pool
+    def __init__(self, pool, entry):
+        self.pool = pool
+        self.entry = entry
+        self.view = memoryview(entry['mmap'])
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+            self.pool.release(self.entry)
+
+class Mmap_Pool():
+    # read-only mappings of large media files shared by every request for the
+    # same path, so concurrent viewers seeking around one title reuse a single
+    # mapping instead of each doing open/seek/read. Mappings nobody has used for
+    # idle_timeout seconds are closed by a background reaper thread.
+    def __init__(self, idle_timeout=MMAP_IDLE_TIMEOUT, max_mappings=MMAP_MAX_MAPPINGS,
+                 revalidate_interval=CACHE_REVALIDATE_INTERVAL):
+        self.idle_timeout = idle_timeout
+        self.max_mappings = max_mappings
+        self.revalidate_interval = revalidate_interval
+        self.mappings = {}   # path -> entry dict
+        self.lock = threading.Lock()
+        self.running = True
+
+        reaper = threading.Thread(target=self.reaper, name="vod-mmap-reaper")
+        reaper.daemon = True
+        reaper.start()
+
+    def acquire(self, path, mtime_ns=None):
+        # returns an Mmap_Lease for path, or None if it can't be mapped
+        now = time.monotonic()
+        with self.lock:
+            entry = self.mappings.get(path)
+            if (entry is not None and now - entry['checked'] < self.revalidate_interval
+                    and (mtime_ns is None or entry['mtime_ns'] == mtime_ns)):
+                return self.lease(entry, now)
+
+        file_stat = os.stat(path)
+        with self.lock:
+            entry = self.mappings.get(path)
+            if entry is not None:
+                if entry['mtime_ns'] == file_stat.st_mtime_ns and entry['size'] == file_stat.st_size:
+                    entry['checked'] = now
+                    return self.lease(entry, now)
+                # file changed, retire the old mapping once its readers finish
+                self.retire(path)
+            if file_stat.st_size == 0 or len(self.mappings) >= self.max_mappings:
+                return None
+
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+
+        with self.lock:
+            entry = self.mappings.get(path)
+            if entry is not None and entry['mtime_ns'] == mtime_ns:
+                # another thread mapped it first
+                mapped.close()
+            else:
+                if entry is not None:
+                    self.retire(path)
+                entry = {
+                    'mmap': mapped,
+                    'size': len(mapped),
+                    'mtime_ns': mtime_ns,
+                    'refs': 0,
+                    'last_used': now,
+                    'checked': now,
+                    'retired': False,
+                }
+                self.mappings[path] = entry
+            return self.lease(entry, now)
+
+    def lease(self, entry, now):
+        # caller holds the lock
+        entry['refs'] += 1
+        entry['last_used'] = now
+        return Mmap_Lease(self, entry)
+
+    def release(self, entry):
+        with self.lock:
+            entry['refs'] -= 1
+            entry['last_used'] = time.monotonic()
+            if entry['retired'] and entry['refs'] == 0:
+                entry['mmap'].close()
+
+    def retire(self, path):
+        # caller holds the lock
+        entry = self.mappings.pop(path)
+        entry['retired'] = True
+        if entry['refs'] == 0:
+            entry['mmap'].close()
+
+    def reaper(self):
+        while self.running:
+            time.sleep(max(1.0, self.idle_timeout / 2))
+            deadline = time.monotonic() - self.idle_timeout
+            with self.lock:
+                for path in [p for p, e in self.mappings.items()
+                             if e['refs'] == 0 and e['last_used'] < deadline]:
+                    self.retire(path)
+
+    def close(self):
+        self.running = False
+        with self.lock:
+            for path in list(self.mappings):
+                self.retire(path)
+
+class Content_Index():
+    # URL path -> file metadata for everything under the content root, kept in
+    # sync with the disk. Updates never modify the published dict: a copy is
+    # changed and swapped in with a single assignment, so request threads see
+    # either the old index or the new one, never something in between.
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+    def __init__(self, root, lazy=INDEX_LAZY_STARTUP, use_inotify=INDEX_USE_INOTIFY,
+                 poll_interval=INDEX_POLL_INTERVAL, scan_threads=INDEX_SCAN_THREADS):
+        self.root = os.path.abspath(root)
+        self.lazy = lazy
+        self.use_inotify = use_inotify
+        self.poll_interval = poll_interval
+        self.scan_threads = max(1, scan_threads)
+        self.entries = {}
+        self.ready = False
+        self.running = True
+        self.update_lock = threading.Lock()   # serialises writers only, readers never take it
+
+        self.inotify_fd = None
+        self.watches = {}                     # watch descriptor -> directory
+        self.subscribers = {}                 # pid -> pipe of a pre-fork worker following this index
+
+    def start(self):
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+            log.info("Directory '%s' created.", self.root)
+
+        if self.lazy:
+            builder = threading.Thread(target=self.build_and_watch, name="vod-index")
+            builder.daemon = True
+            builder.start()
+        else:
+            self.build()
+            watcher = threading.Thread(target=self.watch, name="vod-index")
+            watcher.daemon = True
+            watcher.start()
+
+    def stop(self):
+        self.running = False
+        self.close_inotify()
+
+    def close_inotify(self):
+        if self.inotify_fd is not None:
+            try:
+                os.close(self.inotify_fd)
+            except OSError:
+                pass
+            self.inotify_fd = None
+            self.watches = {}
+
+    def build_and_watch(self):
+        self.build()
+        self.watch()
+
+    def build(self):
+        started = time.monotonic()
+        # start watching before the scan so nothing changed during it is missed
+        if self.use_inotify:
+            self.init_inotify()
+        entries = self.scan()
+        with self.update_lock:
+            self.entries = entries
+            self.ready = True
+        log.info("Indexed %d files in %.2fs", len(entries), time.monotonic() - started)
+
+    def lookup(self, url_path):
+        file_info = self.entries.get(url_path)
+        if file_info is None and not self.ready:
+            # initial scan still running, look at the disk directly
+            file_info = self.stat_url(url_path)
+        return file_info
+
+    def make_entry(self, file_path, file_stat):
+        return {
+            "path": file_path,
+            "size": file_stat.st_size,
+            "modified": datetime.datetime.fromtimestamp(file_stat.st_mtime, datetime.UTC),
+            "mtime_ns": file_stat.st_mtime_ns,
+            # strong validator: changes whenever size or mtime does
+            "etag": f'"{file_stat.st_size:x}-{file_stat.st_mtime_ns:x}"',
+            'type': mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        }
+
+    def url_for(self, file_path):
+        # relative path from content root, converted to a url
+        relative_path = os.path.relpath(file_path, self.root)
+        return "/" + relative_path.replace(os.path.sep, "/")
+
+    def stat_url(self, url_path):
+        parts = url_path.lstrip('/').split('/')
+        if not url_path.startswith('/') or any(part in ('', '.', '..') for part in parts):
+            return None
+        file_path = os.path.join(self.root, *parts)
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            return None
+        if not os.path.isfile(file_path) or file_path.endswith(INDEX_IGNORE_SUFFIXES):
+            return None
+        return self.make_entry(file_path, file_stat)
+
+    def scan(self):
+        # full scan; the top-level directories are walked in parallel since
+        # stat() releases the GIL and dominates on large or networked trees
+        entries = {}
+        subdirs = self.scan_dir(self.root, entries)
+        if subdirs:
+            with concurrent.futures.ThreadPoolExecutor(self.scan_threads) as pool:
+                for result in pool.map(self.scan_tree, subdirs):
+                    entries.update(result)
+        return entries
+
+    def scan_tree(self, top):
+        entries = {}
+        pending = [top]
+        while pending:
+            pending.extend(self.scan_dir(pending.pop(), entries))
+        return entries
+
+    def scan_dir(self, directory, entries):
+        # index the files directly inside directory, returns its subdirectories
+        subdirs = []
+        if self.inotify_fd is not None:
+            self.add_watch(directory)
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.is_file() and not entry.name.endswith(INDEX_IGNORE_SUFFIXES):
+                            entries[self.url_for(entry.path)] = self.make_entry(entry.path, entry.stat())
+                    except OSError as e:
+                        log.warning("Error accessing file '%s': %s", entry.path, e)
+        except OSError as e:
+            log.warning("Error scanning directory '%s': %s", directory, e)
+        return subdirs
+
+    def apply(self, changes):
+        # changes: url path -> new entry, or None for a removed file
+        if not changes:
+            return
+        with self.update_lock:
+            entries = dict(self.entries)
+            for url_path, file_info in changes.items():
+                if file_info is None:
+                    entries.pop(url_path, None)
+                else:
+                    entries[url_path] = file_info
+            self.entries = entries
+            if self.subscribers:
+                self.publish(changes)
+
+    def publish(self, changes):
+        # send a change batch to the worker processes (caller holds update_lock,
+        # so batches arrive in order and never race a fork)
+        payload = pickle.dumps(changes)
+        message = struct.pack('!I', len(payload)) + payload
+        for pid, fd in list(self.subscribers.items()):
+            try:
+                view = memoryview(message)
+                while view:
+                    view = view[os.write(fd, view):]
+            except OSError:
+                # worker is gone, the supervisor will notice and reap it
+                os.close(fd)
+                del self.subscribers[pid]
+
+    def follow(self, fd, on_close):
+        # worker side of publish(): apply the supervisor's change batches to
+        # the inherited index. EOF means the supervisor went away.
+        with os.fdopen(fd, 'rb') as pipe:
+            while True:
+                header = pipe.read(4)
+                if len(header) < 4:
+                    break
+                payload = pipe.read(struct.unpack('!I', header)[0])
+                self.apply(pickle.loads(payload))
+        on_close()
+
+    def watch(self):
+        if self.inotify_fd is not None:
+            self.watch_inotify()
+        elif self.poll_interval > 0:
+            self.watch_poll()
+
+    def watch_poll(self):
+        while self.running:
+            time.sleep(self.poll_interval)
+            current = self.entries
+            scanned = self.scan()
+            changes = {}
+            for url_path, file_info in scanned.items():
+                old = current.get(url_path)
+                if old is None or old['mtime_ns'] != file_info['mtime_ns'] or old['size'] != file_info['size']:
+                    changes[url_path] = file_info
+            for url_path in current:
+                if url_path not in scanned:
+                    changes[url_path] = None
+            self.apply(changes)
+
+    def init_inotify(self):
+        if not sys.platform.startswith('linux'):
+            return
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            log.warning("inotify unavailable, polling instead: %s", e)
+            return
+        if fd < 0:
+            log.warning("inotify unavailable, polling instead: %s", os.strerror(ctypes.get_errno()))
+            return
+        self.libc = libc
+        self.inotify_fd = fd
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.inotify_fd, os.fsencode(directory), self.WATCH_MASK)
+        if wd < 0:
+            # usually fs.inotify.max_user_watches, fall back to polling
+            log.warning("inotify watch on '%s' failed, polling instead: %s", directory, os.strerror(ctypes.get_errno()))
+            self.close_inotify()
+            return
+        self.watches[wd] = directory
+
+    def watch_inotify(self):
+        header = struct.Struct('iIII')
+        while self.running and self.inotify_fd is not None:
+            try:
+                ready, _, _ = select.select([self.inotify_fd], [], [], 1.0)
+                if not ready:
+                    continue
+                # let a burst of events (a file being copied in) settle into one update
+                time.sleep(INDEX_BATCH_DELAY)
+                data = os.read(self.inotify_fd, 1 << 20)
+            except (OSError, ValueError):
+                break
+
+            touched = set()
+            rescan = False
+            offset = 0
+            while offset + header.size <= len(data):
+                wd, mask, cookie, length = header.unpack_from(data, offset)
+                name = data[offset + header.size:offset + header.size + length].rstrip(b'\0')
+                offset += header.size + length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    rescan = True
+                    continue
+                directory = self.watches.get(wd)
+                if directory is None:
+                    continue
+                if mask & self.IN_IGNORED:
+                    del self.watches[wd]
+                    continue
+                if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                    touched.add((directory, True))
+                    continue
+                if name:
+                    touched.add((os.path.join(directory, os.fsdecode(name)), bool(mask & self.IN_ISDIR)))
+
+            if rescan:
+                log.warning("inotify queue overflowed, rescanning content")
+                current = self.entries
+                scanned = self.scan()
+                changes = {url_path: None for url_path in current if url_path not in scanned}
+                changes.update(scanned)
+                self.apply(changes)
+            else:
+                self.apply(self.collect_changes(touched))
+
+        if self.running and self.poll_interval > 0:
+            self.watch_poll()
+
+    def collect_changes(self, touched):
+        changes = {}
+        for path, is_dir in touched:
+            if is_dir:
+                # a directory appeared, vanished or moved: re-index everything under it
+                prefix = self.url_for(path) + "/"
+                for url_path in self.entries:
+                    if url_path.startswith(prefix):
+                        changes[url_path] = None
+                if os.path.isdir(path):
+                    changes.update(self.scan_tree(path))
+                continue
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                changes[self.url_for(path)] = None
+                continue
+            if os.path.isfile(path) and not path.endswith(INDEX_IGNORE_SUFFIXES):
+                changes[self.url_for(path)] = self.make_entry(path, file_stat)
+        return changes
+
+class Content_Listing():
+    # sorted views of the content index behind LISTING_PATH: every path in
+    # order, the paths of each MIME type in order, and (size, path) /
+    # (mtime, path) keys. Prefixes are bisected out of the path lists, so a
+    # listing only touches the entries it returns. The views are rebuilt
+    # when Content_Index publishes a new entries dict; requests arriving
+    # during a rebuild use the previous views.
+    def __init__(self, content_index, hidden=None):
+        self.content_index = content_index
+        self.hidden = hidden      # predicate for paths never listed
+        self.views = None
+        self.lock = threading.Lock()
+
+    def current(self):
+        views = self.views
+        if views is not None and views['source'] is self.content_index.entries:
+            return views
+        if not self.lock.acquire(blocking=views is None):
+            return views
+        try:
+            entries = self.content_index.entries
+            if self.views is None or self.views['source'] is not entries:
+                started = time.monotonic()
+                self.views = self.build(entries)
+                log.debug("Listing index rebuilt in %.3fs", time.monotonic() - started)
+            return self.views
+        finally:
+            self.lock.release()
+
+    def build(self, entries):
+        listed = {path: info for path, info in entries.items() if self.hidden is None or not self.hidden(path)}
+        paths = sorted(listed)
+        by_type = {}
+        for path in paths:
+            by_type.setdefault(listed[path]['type'], []).append(path)
+        return {
+            'source': entries,
+            'entries': listed,
+            'path': paths,
+            'type': by_type,
+            'size': sorted((info['size'], path) for path, info in listed.items()),
+            'mtime': sorted((info['mtime_ns'], path) for path, info in listed.items()),
+            'windows': collections.OrderedDict(),   # (prefix, type, sort) -> sorted keys
+        }
+
+    def query(self, prefix='/', sort='path', descending=False, mime=None, limit=LISTING_DEFAULT_LIMIT, cursor=None):
+        # returns (number of matches, up to limit entries, cursor for the next page or None)
+        views = self.current()
+        listed = views['entries']
+        if mime:
+            # "video/mp4" exactly, or every type under "video/"
+            lists = [paths for file_type, paths in views['type'].items()
+                     if file_type == mime or (mime.endswith('/') and file_type.startswith(mime))]
+        else:
+            lists = [views['path']]
+        end_key = prefix + '\U0010ffff'
+        spans = [(paths, bisect.bisect_left(paths, prefix), bisect.bisect_left(paths, end_key)) for paths in lists]
+        total = sum(hi - lo for _, lo, hi in spans)
+
+        if sort == 'path':
+            keys = self.walk_paths(spans, descending, cursor)
+        else:
+            field = 'size' if sort == 'size' else 'mtime_ns'
+            after = self.parse_cursor(cursor)
+            if total <= LISTING_SORT_WINDOW:
+                keys = self.walk_window(views, spans, prefix, mime, sort, field, descending, after)
+            else:
+                keys = self.walk_sorted(views[sort], prefix, mime, listed, descending, after)
+
+        page = list(itertools.islice(keys, limit + 1))
+        more = len(page) > limit
+        page = page[:limit]
+        items = [listed[key if sort == 'path' else key[1]] for key in page]
+        next_cursor = None
+        if more and page:
+            next_cursor = page[-1] if sort == 'path' else f"{page[-1][0]}:{page[-1][1]}"
+        return total, [(key if sort == 'path' else key[1], item) for key, item in zip(page, items)], next_cursor
+
+    def parse_cursor(self, cursor):
+        # "<size or mtime_ns>:<path>" of the last entry of the previous page
+        if not cursor:
+            return None
+        value, _, path = cursor.partition(':')
+        try:
+            return (int(value), path)
+        except ValueError:
+            return None
+
+    def walk_paths(self, spans, descending, cursor):
+        # merge the prefix ranges of the path-ordered lists, starting after cursor
+        iterators = []
+        for paths, lo, hi in spans:
+            if descending:
+                if cursor:
+                    hi = max(lo, min(hi, bisect.bisect_left(paths, cursor, lo, hi)))
+                iterators.append(map(paths.__getitem__, range(hi - 1, lo - 1, -1)))
+            else:
+                if cursor:
+                    lo = min(hi, max(lo, bisect.bisect_right(paths, cursor, lo, hi)))
+                iterators.append(map(paths.__getitem__, range(lo, hi)))
+        if len(iterators) == 1:
+            return iterators[0]
+        return heapq.merge(*iterators, reverse=descending)
+
+    def walk_window(self, views, spans, prefix, mime, sort, field, descending, after):
+        # few enough matches: sort just them, once per index version, and
+        # keep the result for the following pages
+        window_key = (prefix, mime, sort)
+        windows = views['windows']
+        with self.lock:
+            window = windows.get(window_key)
+            if window is not None:
+                windows.move_to_end(window_key)
+        if window is None:
+            listed = views['entries']
+            window = sorted((listed[paths[i]][field], paths[i]) for paths, lo, hi in spans for i in range(lo, hi))
+            with self.lock:
+                windows[window_key] = window
+                while len(windows) > 64:
+                    windows.popitem(last=False)
+        return self.walk_keys(window, descending, after)
+
+    def walk_sorted(self, keys, prefix, mime, listed, descending, after):
+        # many matches: walk the global order and skip what doesn't match,
+        # which stays cheap precisely because most entries do match
+        for key in self.walk_keys(keys, descending, after):
+            if not key[1].startswith(prefix):
+                continue
+            if mime:
+                file_type = listed[key[1]]['type']
+                if file_type != mime and not (mime.endswith('/') and file_type.startswith(mime)):
+                    continue
+            yield key
+
+    def walk_keys(self, keys, descending, after):
+        if descending:
+            end = bisect.bisect_left(keys, after) if after else len(keys)
+            return map(keys.__getitem__, range(end - 1, -1, -1))
+        start = bisect.bisect_right(keys, after) if after else 0
+        return map(keys.__getitem__, range(start, len(keys)))
+
+class Segment_Index():
+    # splits an MPEG-TS file into segments for HLS-style playback. The
+    # boundaries are placed on keyframes (random access points) about
+    # SEGMENT_DURATION apart and timed from the stream's PCR clock; a stream
+    # without a usable clock is cut into fixed-size runs of whole packets with
+    # durations estimated from SEGMENT_ASSUMED_BITRATE. Other containers (mp4,
+    # mkv, ...) can't be decoded from an arbitrary byte offset, so they aren't
+    # segmented at all. The table is computed once per file version and cached
+    # in memory and in a sidecar file, so serving a segment is just a ranged
+    # read of the original file.
+    def __init__(self):
+        self.tables = {}   # file path -> segment table
+        self.lock = threading.Lock()
+        self.building = {}   # file path -> Event, so one thread builds while others wait
+
+    def get(self, file_info):
+        path = file_info['path']
+        while True:
+            with self.lock:
+                table = self.tables.get(path)
+                if table is not None and table['mtime_ns'] == file_info['mtime_ns'] and table['size'] == file_info['size']:
+                    return table
+                event = self.building.get(path)
+                if event is None:
+                    event = threading.Event()
+                    self.building[path] = event
+                    break
+            event.wait()
+
+        try:
+            table = self.load_sidecar(file_info)
+            if table is None:
+                table = self.build(file_info)
+                self.save_sidecar(file_info, table)
+            with self.lock:
+                self.tables[path] = table
+            return table
+        finally:
+            with self.lock:
+                del self.building[path]
+            event.set()
+
+    def load_sidecar(self, file_info):
+        try:
+            with open(file_info['path'] + SEGMENT_INDEX_SUFFIX, 'r') as f:
+                table = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if table.get('mtime_ns') != file_info['mtime_ns'] or table.get('size') != file_info['size']:
+            return None
+        return table
+
+    def save_sidecar(self, file_info, table):
+        # write-then-rename so a concurrent reader never sees half a sidecar
+        sidecar = file_info['path'] + SEGMENT_INDEX_SUFFIX
+        # temp name keeps the suffix so the content index ignores it too
+        temporary = f"{file_info['path']}.{os.getpid()}.tmp{SEGMENT_INDEX_SUFFIX}"
+        try:
+            with open(temporary, 'w') as f:
+                json.dump(table, f)
+            os.replace(temporary, sidecar)
+        except OSError as e:
+            log.warning("Could not write segment index '%s': %s", sidecar, e)
+
+    def can_segment(self, file_info):
+        return file_info['path'].lower().endswith(TS_EXTENSIONS)
+
+    def build(self, file_info):
+        size = file_info['size']
+        segments = None
+        if size >= TS_PACKET_SIZE:
+            with open(file_info['path'], 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    segments = self.build_ts(data)
+        if segments is None:
+            segments = []
+            step = max(TS_PACKET_SIZE, SEGMENT_SIZE // TS_PACKET_SIZE * TS_PACKET_SIZE)
+            for offset in range(0, size, step):
+                length = min(step, size - offset)
+                segments.append([offset, length, length * 8 / SEGMENT_ASSUMED_BITRATE])
+        return {
+            "size": size,
+            "mtime_ns": file_info['mtime_ns'],
+            "segments": segments,
+        }
+
+    def build_ts(self, data):
+        size = len(data)
+        start = self.ts_sync(data, 0, TS_PACKET_SIZE * 2)
+        if start is None:
+            return None
+        first_pcr = self.ts_find(data, start, SEGMENT_SEARCH_WINDOW, want_pcr=True)
+        last_pcr = self.ts_find(data, max(start, size - SEGMENT_SEARCH_WINDOW), SEGMENT_SEARCH_WINDOW, want_pcr=True)
+        if first_pcr is None or last_pcr is None or last_pcr[1] <= first_pcr[1]:
+            return None
+        # average byte rate gives the nominal distance between boundaries
+        byte_rate = (last_pcr[0] - first_pcr[0]) / (last_pcr[1] - first_pcr[1])
+        step = max(TS_PACKET_SIZE, int(byte_rate * SEGMENT_DURATION) // TS_PACKET_SIZE * TS_PACKET_SIZE)
+
+        boundaries = [start]
+        target = start + step
+        while target < size - TS_PACKET_SIZE:
+            keyframe = self.ts_find(data, target, SEGMENT_SEARCH_WINDOW, want_keyframe=True)
+            boundary = keyframe[0] if keyframe is not None else target
+            boundaries.append(boundary)
+            target = boundary + step
+        boundaries.append(size)
+
+        times = []
+        for boundary in boundaries[:-1]:
+            pcr = self.ts_find(data, boundary, SEGMENT_SEARCH_WINDOW, want_pcr=True)
+            times.append(pcr[1] if pcr is not None else None)
+        times.append(last_pcr[1] + (size - last_pcr[0]) / byte_rate)
+
+        segments = []
+        for i in range(len(boundaries) - 1):
+            offset, length = boundaries[i], boundaries[i + 1] - boundaries[i]
+            if times[i] is not None and times[i + 1] is not None and times[i + 1] > times[i]:
+                duration = times[i + 1] - times[i]
+            else:
+                # no usable clock here (or it wrapped), estimate from the average rate
+                duration = length / byte_rate
+            segments.append([offset, length, duration])
+        return segments
+
+    def ts_sync(self, data, offset, window):
+        # first offset at or after offset where two consecutive packets start with 0x47
+        end = min(len(data) - TS_PACKET_SIZE, offset + window)
+        while offset <= end:
+            offset = data.find(b'\x47', offset, end + 1)
+            if offset == -1:
+                return None
+            if offset + TS_PACKET_SIZE >= len(data) or data[offset + TS_PACKET_SIZE] == 0x47:
+                return offset
+            offset += 1
+        return None
+
+    def ts_find(self, data, offset, window, want_pcr=False, want_keyframe=False):
+        # walk packets from offset; returns (packet offset, pcr seconds or None)
+        # for the first one that has a PCR / is a random access point
+        offset = self.ts_sync(data, offset, TS_PACKET_SIZE * 2)
+        if offset is None:
+            return None
+        end = min(len(data) - TS_PACKET_SIZE, offset + window)
+        while offset <= end:
+            if data[offset] != 0x47:
+                offset = self.ts_sync(data, offset, TS_PACKET_SIZE * 2)
+                if offset is None:
+                    return None
+                continue
+            adaptation = (data[offset + 3] >> 4) & 0x2
+            if adaptation and data[offset + 4] > 0:
+                flags = data[offset + 5]
+                pcr = None
+                if flags & 0x10 and data[offset + 4] >= 7:
+                    b = data[offset + 6:offset + 12]
+                    base = (b[0] << 25) | (b[1] << 17) | (b[2] << 9) | (b[3] << 1) | (b[4] >> 7)
+                    extension = ((b[4] & 0x1) << 8) | b[5]
+                    pcr = (base * 300 + extension) / 27000000
+                if (want_pcr and pcr is not None) or (want_keyframe and flags & 0x40):
+                    return offset, pcr
+            offset += TS_PACKET_SIZE
+        return None
+
+    def playlist(self, table, segment_ext):
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{max(1, math.ceil(max(s[2] for s in table['segments'])))}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            "#EXT-X-PLAYLIST-TYPE:VOD",
+        ]
+        for number, (offset, length, duration) in enumerate(table['segments']):
+            lines.append(f"#EXTINF:{max(duration, SEGMENT_MIN_DURATION):.3f},")
+            lines.append(f"{number}{segment_ext}")
+        lines.append("#EXT-X-ENDLIST")
+        return ("\n".join(lines) + "\n").encode()
+
+    def bandwidth(self, table):
+        # peak segment bitrate, what HLS wants in BANDWIDTH
+        return max(int(length * 8 / max(duration, SEGMENT_MIN_DURATION)) for offset, length, duration in table['segments'])
+
+class Origin_Fetch():
+    # one download from the origin, shared by every request that wants the
+    # file while it is in flight. The body goes to a temp file that readers
+    # stream from as it grows.
+    def __init__(self, url_path, temp_path):
+        self.url_path = url_path
+        self.temp_path = temp_path
+        self.path = temp_path     # where readers open it, the final name once stored
+        self.cond = threading.Condition()
+        self.status = None        # origin status, None until its headers arrive
+        self.size = None
+        self.etag = None
+        self.last_modified = None
+        self.type = None
+        self.received = 0
+        self.done = False
+        self.error = None
+        self.meta = None          # set when the file turned out to be sliced
+
+    def set_headers(self, status, size, etag, last_modified, content_type):
+        with self.cond:
+            self.status = status
+            self.size = size
+            self.etag = etag
+            self.last_modified = last_modified
+            self.type = content_type
+            self.cond.notify_all()
+
+    def advance(self, amount):
+        with self.cond:
+            self.received += amount
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.done = True
+            if error is not None and self.error is None:
+                self.error = error
+            self.cond.notify_all()
+
+    def wait_headers(self, timeout):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.status is not None or self.done, timeout)
+
+    def wait_for(self, offset, timeout):
+        # block until the byte at offset is on disk, returns how many bytes are
+        with self.cond:
+            while self.received <= offset and not self.done:
+                if not self.cond.wait(timeout):
+                    raise OSError(f"origin stalled fetching {self.url_path}")
+            if self.received <= offset:
+                raise OSError(f"origin fetch of {self.url_path} failed: {self.error}")
+            return self.received
+
+    def wait_done(self, timeout):
+        with self.cond:
+            while not self.done:
+                if not self.cond.wait(timeout):
+                    raise OSError(f"origin stalled fetching {self.url_path}")
+
+    def open_reader(self):
+        with self.cond:
+            return open(self.path, 'rb')
+
+    def file_info(self):
+        # enough of an index entry to render headers for the file in flight
+        modified = None
+        if self.last_modified:
+            try:
+                modified = email.utils.parsedate_to_datetime(self.last_modified)
+            except (TypeError, ValueError, IndexError):
+                pass
+        if modified is None:
+            modified = datetime.datetime.now(datetime.UTC)
+        return {
+            "path": self.path,
+            "size": self.size,
+            "modified": modified,
+            "mtime_ns": int(modified.timestamp()) * 1000000000,
+            "etag": self.etag or '"origin-%x"' % id(self),
+            "type": self.type,
+        }
+
+class Origin_Cache():
+    # edge cache mode: files missing from the content dir are pulled from an
+    # origin (another Vod_Server works) into a disk cache with an LRU byte
+    # budget. Concurrent misses for a file share one Origin_Fetch. Pre-fork
+    # workers share the directory: each one picks up files the others stored,
+    # but enforces the budget on the files it knows about.
+    #
+    # Files larger than one slice are stored as ORIGIN_SLICE_SIZE slices
+    # fetched with Range requests as they are needed, so a viewer seeking
+    # around a title only pulls the parts they watch. Every miss starts with a
+    # request for the first slice; its Content-Range tells which kind it is.
+    def __init__(self, origin, root=ORIGIN_CACHE_DIR, max_bytes=ORIGIN_CACHE_MAX_BYTES,
+                 ttl=ORIGIN_CACHE_TTL, timeout=ORIGIN_TIMEOUT, slice_size=ORIGIN_SLICE_SIZE):
+        url = urllib.parse.urlsplit(origin)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise ValueError(f"Unsupported origin: {origin}")
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.base_path = url.path.rstrip('/')
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.timeout = timeout
+        self.slice_size = slice_size
+
+        self.lock = threading.Lock()
+        # url path (whole file) or (url path, slice number) -> entry, least recently used first
+        self.entries = collections.OrderedDict()
+        self.total = 0
+        self.sliced = {}                           # url path -> metadata of a sliced file
+        self.fetches = {}                          # entry key -> Origin_Fetch in flight
+        self.idle_connections = []                 # kept-alive connections to the origin
+        self.hits = 0
+        self.fetch_count = 0
+        self.load()
+
+    def key_path(self, url_path):
+        digest = hashlib.sha1(url_path.encode('utf-8', 'surrogateescape')).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    def slice_path(self, meta, number):
+        # slices of one version of the file share a directory, dropped as a whole when it changes
+        return os.path.join(meta['path'] + '.slices', meta['version'], str(number))
+
+    def slice_count(self, meta):
+        return -(-meta['size'] // meta['slice_size'])
+
+    def slice_length(self, meta, number):
+        return min(meta['slice_size'], meta['size'] - number * meta['slice_size'])
+
+    def load(self):
+        # pick up what a previous run stored, oldest first; leftovers of
+        # downloads that died mid-way are removed
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        slices = []
+        stale_before = time.time() - max(self.timeout, 60.0)
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    if name.endswith('.part'):
+                        if os.stat(path).st_mtime < stale_before:
+                            os.unlink(path)
+                        continue
+                    if name.isdigit():
+                        slices.append((os.stat(path).st_mtime, path))
+                        continue
+                    if not name.endswith('.json'):
+                        continue
+                    with open(path) as f:
+                        entry = json.load(f)
+                    entry['path'] = path[:-len('.json')]
+                    if entry.get('sliced'):
+                        self.sliced[entry['url']] = entry
+                    else:
+                        found.append((os.stat(entry['path']).st_mtime, entry))
+                except (OSError, ValueError) as e:
+                    log.debug("Skipping cache file %s: %s", path, e)
+
+        # <key>.slices/<version>/<n>: keep the slices of versions we have metadata for
+        by_key = {meta['path']: meta for meta in self.sliced.values()}
+        for mtime, path in slices:
+            version_dir = os.path.dirname(path)
+            meta = by_key.get(os.path.dirname(version_dir)[:-len('.slices')])
+            if meta is None or os.path.basename(version_dir) != meta['version']:
+                os.unlink(path)
+                continue
+            number = int(os.path.basename(path))
+            found.append((mtime, {'url': meta['url'], 'slice': number, 'path': path,
+                                  'size': os.stat(path).st_size}))
+
+        found.sort(key=lambda item: item[0])
+        with self.lock:
+            for _, entry in found:
+                self.register(entry)
+            self.evict()
+        if found:
+            log.info("Edge cache: %d files and slices, %d bytes in %s", len(self.entries), self.total, self.root)
+
+    def load_entry(self, url_path):
+        # a file another worker process stored
+        path = self.key_path(url_path)
+        try:
+            with open(path + '.json') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url_path:
+            return None
+        entry['path'] = path
+        with self.lock:
+            if entry.get('sliced'):
+                current = self.sliced.get(url_path)
+                if current is None or current['checked'] < entry['checked']:
+                    self.sliced[url_path] = entry
+                return None
+            if url_path not in self.entries:
+                self.register(entry)
+                self.evict()
+            return self.entries.get(url_path)
+
+    def entry_key(self, entry):
+        return entry['url'] if 'slice' not in entry else (entry['url'], entry['slice'])
+
+    def register(self, entry):
+        # caller holds the lock
+        key = self.entry_key(entry)
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.total -= old['size']
+        self.entries[key] = entry
+        self.total += entry['size']
+
+    def evict(self):
+        # caller holds the lock
+        while self.total > self.max_bytes and self.entries:
+            key, entry = self.entries.popitem(last=False)
+            self.total -= entry['size']
+            paths = [entry['path']] if 'slice' in entry else [entry['path'], entry['path'] + '.json']
+            for path in paths:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            log.debug("Evicted %s from the edge cache", key)
+
+    def forget(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.total -= entry['size']
+
+    def invalidate(self, meta):
+        # the origin has a new version of a sliced file: drop the old slices
+        with self.lock:
+            if self.sliced.get(meta['url']) is meta:
+                del self.sliced[meta['url']]
+            for number in range(self.slice_count(meta)):
+                entry = self.entries.get((meta['url'], number))
+                if entry is not None and entry['path'] == self.slice_path(meta, number):
+                    del self.entries[(meta['url'], number)]
+                    self.total -= entry['size']
+        shutil.rmtree(os.path.dirname(self.slice_path(meta, 0)), ignore_errors=True)
+
+    def lookup(self, url_path, fresh=True):
+        # index entry of a file stored whole, None if it isn't (or, with
+        # fresh, if it is due for revalidation)
+        with self.lock:
+            entry = self.entries.get(url_path)
+            if entry is not None:
+                self.entries.move_to_end(url_path)
+        if entry is None:
+            entry = self.load_entry(url_path)
+            if entry is None:
+                return None
+        try:
+            file_stat = os.stat(entry['path'])
+        except OSError:
+            self.forget(url_path)
+            return None
+        if fresh and time.time() - entry['checked'] > self.ttl:
+            return None
+        if fresh:
+            with self.lock:
+                self.hits += 1
+        file_info = entry.get('info')
+        if file_info is None or file_info['mtime_ns'] != file_stat.st_mtime_ns:
+            file_info = {
+                "path": entry['path'],
+                "size": file_stat.st_size,
+                "modified": datetime.datetime.fromtimestamp(file_stat.st_mtime, datetime.UTC),
+                "mtime_ns": file_stat.st_mtime_ns,
+                "etag": entry['etag'] or f'"{file_stat.st_size:x}-{file_stat.st_mtime_ns:x}"',
+                'type': entry['type'],
+            }
+            entry['info'] = file_info
+        return file_info
+
+    def lookup_sliced(self, url_path):
+        # metadata of a fresh sliced file, None if unknown or due for revalidation
+        meta = self.sliced.get(url_path)
+        if meta is None:
+            self.load_entry(url_path)
+            meta = self.sliced.get(url_path)
+        if meta is None or time.time() - meta['checked'] > self.ttl:
+            return None
+        with self.lock:
+            self.hits += 1
+        return meta
+
+    def sliced_info(self, meta):
+        # index-entry look-alike of a sliced file, for the header helpers
+        file_info = meta.get('info')
+        if file_info is None:
+            modified = None
+            if meta.get('last_modified'):
+                try:
+                    modified = email.utils.parsedate_to_datetime(meta['last_modified'])
+                except (TypeError, ValueError, IndexError):
+                    pass
+            if modified is None:
+                modified = datetime.datetime.fromtimestamp(int(meta['checked']), datetime.UTC)
+            file_info = {
+                "path": None,
+                "size": meta['size'],
+                "modified": modified,
+                "mtime_ns": int(modified.timestamp()) * 1000000000,
+                "etag": meta['etag'] or f'"{meta["size"]:x}-{meta["version"]}"',
+                'type': meta['type'],
+            }
+            meta['info'] = file_info
+        return file_info
+
+    def fetch(self, url_path):
+        # join the download of url_path or start one. None if a fresh copy
+        # was stored in the meantime.
+        with self.lock:
+            fetch = self.fetches.get(url_path)
+            if fetch is not None:
+                return fetch
+            stale = self.entries.get(url_path) or self.sliced.get(url_path)
+            if stale is not None and time.time() - stale['checked'] <= self.ttl:
+                return None
+            path = self.key_path(url_path)
+            fetch = Origin_Fetch(url_path, f"{path}.{os.getpid()}-{threading.get_ident()}.part")
+            self.fetches[url_path] = fetch
+            self.fetch_count += 1
+        downloader = threading.Thread(target=self.download, args=(fetch, stale), name="vod-origin")
+        downloader.daemon = True
+        downloader.start()
+        return fetch
+
+    def get_slice(self, meta, number):
+        # path of a stored slice, or the Origin_Fetch bringing it in
+        key = (meta['url'], number)
+        path = self.slice_path(meta, number)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['path'] == path:
+                self.entries.move_to_end(key)
+                return path
+            fetch = self.fetches.get(key)
+            if fetch is not None:
+                return fetch
+        if os.path.exists(path):
+            # stored by another worker process
+            with self.lock:
+                self.register({'url': meta['url'], 'slice': number, 'path': path,
+                               'size': self.slice_length(meta, number)})
+                self.evict()
+            return path
+        return self.fetch_slice(meta, number)
+
+    def prefetch(self, meta, number):
+        # start fetching a slice that is likely to be wanted soon
+        key = (meta['url'], number)
+        with self.lock:
+            if key in self.fetches or key in self.entries:
+                return
+        if not os.path.exists(self.slice_path(meta, number)):
+            self.fetch_slice(meta, number)
+
+    def fetch_slice(self, meta, number):
+        key = (meta['url'], number)
+        path = self.slice_path(meta, number)
+        with self.lock:
+            fetch = self.fetches.get(key)
+            if fetch is not None:
+                return fetch
+            fetch = Origin_Fetch(meta['url'], f"{path}.{os.getpid()}-{threading.get_ident()}.part")
+            self.fetches[key] = fetch
+            self.fetch_count += 1
+        downloader = threading.Thread(target=self.download_slice, args=(fetch, meta, number), name="vod-origin")
+        downloader.daemon = True
+        downloader.start()
+        return fetch
+
+    def connect(self):
+        with self.lock:
+            if self.idle_connections:
+                return self.idle_connections.pop()
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def release(self, connection, response):
+        # keep the connection for the next fetch if the origin lets us
+        if response is not None and response.isclosed() and not response.will_close:
+            with self.lock:
+                if len(self.idle_connections) < 16:
+                    self.idle_connections.append(connection)
+                    return
+        connection.close()
+
+    def request(self, url_path, request_headers):
+        # a kept-alive connection may have been closed by the origin meanwhile,
+        # in which case the request is retried once on a fresh one
+        for attempt in range(2):
+            connection = self.connect()
+            try:
+                connection.request('GET', self.base_path + urllib.parse.quote(url_path), headers=request_headers)
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                connection.close()
+                if attempt:
+                    raise
+
+    def download(self, fetch, stale):
+        # runs on its own thread so a client hanging up doesn't abort the fill
+        connection = response = None
+        error = None
+        try:
+            request_headers = {'Accept-Encoding': 'identity'}
+            if self.slice_size > 0:
+                request_headers['Range'] = f"bytes=0-{self.slice_size - 1}"
+            if stale is not None and stale['etag']:
+                request_headers['If-None-Match'] = stale['etag']
+            connection, response = self.request(fetch.url_path, request_headers)
+            length = response.getheader('Content-Length')
+            size = int(length) if length is not None and length.isdigit() else None
+
+            if response.status == 304 and stale is not None:
+                response.read()
+                stale['checked'] = time.time()
+                self.save_meta(stale)
+                if stale.get('sliced'):
+                    fetch.meta = stale
+                fetch.set_headers(304, stale['size'], stale['etag'], None, stale['type'])
+                return
+
+            meta = None
+            if response.status == 206:
+                start, _, total = self.parse_content_range(response.getheader('Content-Range'))
+                if start != 0 or total is None:
+                    raise ValueError(f"unexpected Content-Range {response.getheader('Content-Range')!r}")
+                if total > self.slice_size:
+                    meta = self.new_sliced(fetch, response, total, stale)
+                else:
+                    size = total
+            elif response.status != 200:
+                response.read()
+                fetch.set_headers(response.status, None, None, None, None)
+                return
+            if meta is None and stale is not None and stale.get('sliced'):
+                # no longer large enough to slice
+                self.invalidate(stale)
+
+            os.makedirs(os.path.dirname(fetch.temp_path), exist_ok=True)
+            with open(fetch.temp_path, 'wb', buffering=0) as f:
+                fetch.set_headers(200, size, response.getheader('ETag'), response.getheader('Last-Modified'),
+                                  response.getheader('Content-Type') or 'application/octet-stream')
+                while True:
+                    data = response.read1(SEND_CHUNK_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+                    fetch.advance(len(data))
+            if meta is not None:
+                if fetch.received != self.slice_length(meta, 0):
+                    raise OSError(f"origin sent {fetch.received} bytes of slice 0")
+                self.store_slice(fetch, meta, 0)
+                return
+            if size is not None and fetch.received != size:
+                raise OSError(f"origin sent {fetch.received} of {size} bytes")
+            self.store(fetch)
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            log.warning("Origin fetch of %s failed: %s", fetch.url_path, e)
+            error = e
+            response = None
+            try:
+                os.unlink(fetch.temp_path)
+            except OSError:
+                pass
+        finally:
+            with self.lock:
+                self.fetches.pop(fetch.url_path, None)
+                if self.fetches.get((fetch.url_path, 0)) is fetch:
+                    del self.fetches[(fetch.url_path, 0)]
+            fetch.finish(error)
+            if connection is not None:
+                self.release(connection, response)
+
+    def new_sliced(self, fetch, response, total, stale):
+        # the first slice of a large file arrived: record the file as sliced
+        # and let the request for it double as the fetch of slice 0
+        etag = response.getheader('ETag')
+        if stale is not None and stale.get('sliced'):
+            self.invalidate(stale)
+        elif stale is not None:
+            # it used to be stored whole
+            self.forget(fetch.url_path)
+            try:
+                os.unlink(stale['path'])
+            except OSError:
+                pass
+        path = self.key_path(fetch.url_path)
+        meta = {
+            'url': fetch.url_path,
+            'path': path,
+            'sliced': True,
+            'size': total,
+            'slice_size': self.slice_size,
+            'version': hashlib.sha1(f"{etag}-{total}-{time.time()}".encode()).hexdigest()[:12],
+            'etag': etag,
+            'last_modified': response.getheader('Last-Modified'),
+            'type': response.getheader('Content-Type') or 'application/octet-stream',
+            'checked': time.time(),
+        }
+        self.save_meta(meta)
+        fetch.temp_path = fetch.path = self.slice_path(meta, 0) + f".{os.getpid()}-{threading.get_ident()}.part"
+        fetch.meta = meta
+        with self.lock:
+            self.sliced[fetch.url_path] = meta
+            self.fetches[(fetch.url_path, 0)] = fetch
+        return meta
+
+    def download_slice(self, fetch, meta, number):
+        connection = response = None
+        error = None
+        try:
+            first = number * meta['slice_size']
+            last = first + self.slice_length(meta, number) - 1
+            connection, response = self.request(meta['url'], {'Accept-Encoding': 'identity',
+                                                              'Range': f"bytes={first}-{last}"})
+            etag = response.getheader('ETag')
+            if response.status != 206 or self.parse_content_range(response.getheader('Content-Range')) != (first, last, meta['size']):
+                response.read()
+                raise ValueError(f"origin answered slice {number} with {response.status} "
+                                 f"{response.getheader('Content-Range')!r}")
+            if meta['etag'] and etag and etag != meta['etag']:
+                response.read()
+                self.invalidate(meta)
+                raise ValueError("file changed on the origin")
+
+            os.makedirs(os.path.dirname(fetch.temp_path), exist_ok=True)
+            with open(fetch.temp_path, 'wb', buffering=0) as f:
+                fetch.set_headers(206, last - first + 1, etag, None, meta['type'])
+                while True:
+                    data = response.read1(SEND_CHUNK_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+                    fetch.advance(len(data))
+            if fetch.received != last - first + 1:
+                raise OSError(f"origin sent {fetch.received} bytes of slice {number}")
+            self.store_slice(fetch, meta, number)
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            log.warning("Origin fetch of %s slice %d failed: %s", meta['url'], number, e)
+            error = e
+            response = None
+            try:
+                os.unlink(fetch.temp_path)
+            except OSError:
+                pass
+        finally:
+            with self.lock:
+                self.fetches.pop((meta['url'], number), None)
+            fetch.finish(error)
+            if connection is not None:
+                self.release(connection, response)
+
+    def parse_content_range(self, value):
+        # "bytes a-b/total" -> (a, b, total or None)
+        try:
+            unit, _, spec = value.partition(' ')
+            span, _, total = spec.partition('/')
+            first, _, last = span.partition('-')
+            if unit != 'bytes':
+                raise ValueError
+            return int(first), int(last), (None if total == '*' else int(total))
+        except (AttributeError, ValueError):
+            return None, None, None
+
+    def store(self, fetch):
+        # the download is complete: give it its final name and an LRU slot.
+        # The file keeps the origin's Last-Modified as its mtime, so
+        # If-Modified-Since works the same as for local content.
+        path = self.key_path(fetch.url_path)
+        if fetch.last_modified:
+            try:
+                modified = email.utils.parsedate_to_datetime(fetch.last_modified).timestamp()
+                os.utime(fetch.temp_path, (modified, modified))
+            except (TypeError, ValueError, IndexError, OverflowError):
+                pass
+        if fetch.received > self.max_bytes:
+            # streamed through but too big to keep
+            os.unlink(fetch.temp_path)
+            return
+        with fetch.cond:
+            os.replace(fetch.temp_path, path)
+            fetch.path = path
+        entry = {
+            'url': fetch.url_path,
+            'path': path,
+            'size': fetch.received,
+            'etag': fetch.etag,
+            'type': fetch.type,
+            'checked': time.time(),
+        }
+        self.save_meta(entry)
+        with self.lock:
+            self.register(entry)
+            self.evict()
+
+    def store_slice(self, fetch, meta, number):
+        path = self.slice_path(meta, number)
+        with fetch.cond:
+            os.replace(fetch.temp_path, path)
+            fetch.path = path
+        with self.lock:
+            self.register({'url': meta['url'], 'slice': number, 'path': path, 'size': fetch.received})
+            self.evict()
+
+    def save_meta(self, entry):
+        meta = {key: value for key, value in entry.items() if key not in ('path', 'info')}
+        temp_path = f"{entry['path']}.{os.getpid()}.json.part"
+        os.makedirs(os.path.dirname(temp_path), exist_ok=True)
+        with open(temp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(temp_path, entry['path'] + '.json')
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "fetches": self.fetch_count, "bytes": self.total}
 
 class Vod_Server():
-    def __init__(self, port_id):
+    def __init__(self, port_id, mode=CONCURRENCY_MODE, workers=WORKER_COUNT, backlog=ACCEPT_BACKLOG,
+                 processes=PREFORK_PROCESSES, origin=ORIGIN):
+        if mode not in ("thread", "select", "asyncio"):
+            raise ValueError(f"Unknown concurrency mode: {mode}")
+        self.log_listener = setup_logging()
+
         # create an HTTP port to listen to
-        self.http_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.http_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.http_socket.bind(("", port_id))
-        self.http_socket.listen(10000)
+        self.port_id = port_id
+        self.backlog = backlog
+        self.processes = max(1, processes)
+        self.reuse_port = self.processes > 1 and PREFORK_REUSEPORT and hasattr(socket, 'SO_REUSEPORT')
+        self.http_socket = self.bind_socket(listen=not self.reuse_port)
         self.remain_threads = True
         self.content_root = os.path.abspath("content")
 
-        # load all contents in the buffer
-        self.content_list = self.load_contents("content")
+        self.mode = mode
+        self.worker_count = max(1, workers)
+        self.origin = origin
+
+        # load all contents in the buffer; the pre-fork supervisor builds the
+        # index up front so its workers inherit it instead of each scanning
+        self.content_index = Content_Index(self.content_root,
+                                           lazy=INDEX_LAZY_STARTUP and self.processes == 1)
+        self.content_index.start()
+        if self.processes > 1:
+            self.supervise()
+            return
+        self.run_process()
+
+    def bind_socket(self, listen=True):
+        # with SO_REUSEPORT every worker process binds its own socket and the
+        # kernel spreads connections over them. The supervisor binds one too
+        # (without listening) so a busy port fails at startup.
+        http_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        http_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            http_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        http_socket.bind(("", self.port_id))
+        if listen:
+            http_socket.listen(self.backlog)
+        return http_socket
+
+    def run_process(self):
+        # per-process state: queues, caches, pools and worker threads
+        # bounded job queue of connections with a complete request: when it is
+        # full, SHED_LOAD answers 503, otherwise the select loop blocks until a
+        # worker is free
+        self.job_queue = queue.Queue(maxsize=self.worker_count * 2)
+        self.worker_threads = []
+        # keep-alive connections handed back to the select loop by the workers
+        self.idle_connections = queue.Queue()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+
+        self.content_cache = Content_Cache()
+        self.compressed_cache = Content_Cache(COMPRESS_CACHE_BYTES, COMPRESS_CACHE_BYTES)
+        self.mmap_pool = Mmap_Pool()
+        # the asyncio server sends bodies after the handler has returned its
+        # lease, so it uses sendfile for ranges instead of shared mappings
+        self.mmap_ranges = MMAP_RANGES and self.mode != "asyncio"
+        self.segment_index = Segment_Index()
+        self.rendition_groups = None   # master playlist groups of the current content index
+        self.content_listing = Content_Listing(self.content_index, self.is_confidential)
+        self.traffic_shaper = Traffic_Shaper()
+        self.connection_limiter = Connection_Limiter(*self.connection_limits())
+        self.metrics = Server_Metrics()
+        self.origin_cache = Origin_Cache(self.origin) if self.origin else None
+
+        # pre-rendered header pieces
+        self.status_lines = {}
+        self.cached_date = (0, b'')
         
-        print(f"Server started on port {port_id}")
-        print(f"Content root: {self.content_root}")
-        print(f"Loaded {len(self.content_list)} files")
+        log.info("Server started on port %s", self.port_id)
+        log.info("Content root: %s", self.content_root)
+        if self.content_index.ready:
+            log.info("Loaded %s files", len(self.content_list))
+        if self.origin_cache is not None:
+            log.info("Edge cache mode, origin %s", self.origin)
+        log.info("Concurrency: %s mode, %s workers, backlog %s", self.mode, self.worker_count, self.backlog)
+        log.info("Connection limits: %s in total, %s per client IP",
+                 self.connection_limiter.max_connections or "unlimited", self.connection_limiter.max_per_ip or "unlimited")
 
         # listen to the http socket
         self.listen()
         # pass
 
-    def load_contents(self, dir):
-        #Create a list of files and stuff that you have
-        content_list = {}
+    def supervise(self):
+        # pre-fork supervisor: forks the server processes, keeps the content
+        # index live for them and replaces any that die. SIGHUP starts a fresh
+        # generation and retires the old one once its requests finish, SIGTERM
+        # or Ctrl-C stops everything.
+        self.children = {}      # pid -> generation
+        self.retiring = {}      # pid -> deadline for finishing its requests
+        self.generation = 0
+        self.reload_requested = False
+        signal.signal(signal.SIGHUP, self.request_reload)
+        signal.signal(signal.SIGTERM, self.terminate)
+        log.info("Pre-fork mode: %s processes on port %s, %s", self.processes, self.port_id,
+                 "SO_REUSEPORT" if self.reuse_port else "shared listening socket")
 
-        if not os.path.exists(dir):
-            os.makedirs(dir)
-            print(f"Directory '{dir}' created.")
-            return content_list
+        last_respawn = 0.0
+        try:
+            for _ in range(self.processes):
+                self.spawn_process()
+            while True:
+                time.sleep(0.2)
+                self.reap_processes()
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload_processes()
+                missing = self.processes - sum(1 for g in self.children.values() if g == self.generation)
+                if missing > 0 and time.monotonic() - last_respawn >= PREFORK_RESPAWN_DELAY:
+                    last_respawn = time.monotonic()
+                    self.spawn_process()
+        except (KeyboardInterrupt, SystemExit):
+            log.info("Server shutting down...")
+        finally:
+            self.stop_processes()
+            self.content_index.stop()
+            self.http_socket.close()
+            if self.log_listener is not None:
+                self.log_listener.stop()
 
-        for root, dirs, files in os.walk(dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                # relative path from content root
-                relative_path = os.path.relpath(file_path, dir)
-                # convert url
-                url_path = "/" + relative_path.replace(os.path.sep, "/")
+    def spawn_process(self):
+        read_fd, write_fd = os.pipe()
+        # fork while holding the index lock so no change batch is half applied
+        # or sent before this worker is subscribed to the following ones
+        self.content_index.update_lock.acquire()
+        try:
+            # the index lives in the permanent generation, so the collector
+            # doesn't touch (and un-share) its pages in every worker
+            gc.freeze()
+            pid = os.fork()
+        except OSError:
+            self.content_index.update_lock.release()
+            os.close(read_fd)
+            os.close(write_fd)
+            raise
 
+        if pid == 0:
+            # never return into the supervisor's code from the child
+            status = 1
+            try:
+                os.close(write_fd)
+                self.run_child(read_fd)
+                status = 0
+            except BaseException as e:
+                log.exception("Worker process failed: %s", e)
+            finally:
                 try:
-                    file_stat = os.stat(file_path)
-                    content_list[url_path] = {
-                        "path": file_path,
-                        "size": file_stat.st_size,
-                        "modified": datetime.datetime.fromtimestamp(file_stat.st_mtime),
-                        'type': mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
-                    }
-                except OSError as e:
-                    print(f"Error accessing file '{file_path}': {e}")
-                    continue
-        return content_list
+                    if self.log_listener is not None:
+                        self.log_listener.stop()
+                finally:
+                    os._exit(status)
+
+        self.content_index.subscribers[pid] = write_fd
+        self.content_index.update_lock.release()
+        os.close(read_fd)
+        self.children[pid] = self.generation
+        log.info("Started worker process %s", pid)
+
+    def run_child(self, index_fd):
+        # runs in the forked process. Undo what belongs to the supervisor:
+        # its signal handlers, its lock, its inotify descriptor, the other
+        # workers' pipes and its log writer thread.
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)   # Ctrl-C reaches the supervisor, which stops us
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        index = self.content_index
+        index.update_lock = threading.Lock()
+        for fd in index.subscribers.values():
+            os.close(fd)
+        index.subscribers = {}
+        index.close_inotify()
+        index.running = False
+
+        for handler in list(log.handlers):
+            log.removeHandler(handler)
+        self.log_listener = setup_logging()
+
+        if self.reuse_port:
+            self.http_socket.close()
+            self.http_socket = self.bind_socket()
+
+        follower = threading.Thread(target=index.follow, name="vod-index",
+                                    args=(index_fd, lambda: os.kill(os.getpid(), signal.SIGTERM)))
+        follower.daemon = True
+        follower.start()
+        self.run_process()
+
+    def reap_processes(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation = self.children.pop(pid, None)
+            self.retiring.pop(pid, None)
+            # publish() may be writing to this pipe on the index thread; under
+            # its lock the fd can't be closed (and its number reused) mid-write
+            with self.content_index.update_lock:
+                fd = self.content_index.subscribers.pop(pid, None)
+                if fd is not None:
+                    os.close(fd)
+            if generation == self.generation and self.remain_threads:
+                log.warning("Worker process %s exited unexpectedly (status %s), respawning", pid, status)
+            else:
+                log.info("Worker process %s exited", pid)
+
+        now = time.monotonic()
+        for pid, deadline in list(self.retiring.items()):
+            if now > deadline:
+                log.warning("Worker process %s did not finish in time, killing it", pid)
+                self.signal_process(pid, signal.SIGKILL)
+                del self.retiring[pid]
+
+    def reload_processes(self):
+        # new generation first, so the port keeps being served, then the old
+        # processes stop accepting and finish what they have
+        log.info("Reloading worker processes")
+        self.generation += 1
+        old = [pid for pid, generation in self.children.items() if generation < self.generation]
+        for _ in range(self.processes):
+            self.spawn_process()
+        for pid in old:
+            self.signal_process(pid, signal.SIGTERM)
+            self.retiring[pid] = time.monotonic() + SHUTDOWN_GRACE
+
+    def stop_processes(self):
+        self.remain_threads = False
+        for pid in self.children:
+            self.signal_process(pid, signal.SIGTERM)
+        deadline = time.monotonic() + SHUTDOWN_GRACE
+        while self.children and time.monotonic() < deadline:
+            self.reap_processes()
+            time.sleep(0.1)
+        for pid in self.children:
+            self.signal_process(pid, signal.SIGKILL)
+
+    def signal_process(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def request_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def connection_limits(self):
+        # (total, per IP) for the Connection_Limiter. Derived by default, so
+        # admission control turns clients away before accept() runs out of
+        # descriptors and before one client holds every worker
+        max_connections = MAX_CONNECTIONS
+        if max_connections is None:
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft == resource.RLIM_INFINITY:
+                max_connections = 0
+            else:
+                # every worker may have a content file (and the asyncio server
+                # a dup of it) open, and each cached mapping keeps a descriptor
+                reserved = FD_HEADROOM + 2 * self.worker_count + (MMAP_MAX_MAPPINGS if self.mmap_ranges else 0)
+                max_connections = max(soft // 2, soft - reserved)
+        max_per_ip = MAX_CONNECTIONS_PER_IP
+        if max_per_ip is None:
+            max_per_ip = max(1, self.worker_count // 2)
+        return max_connections, max_per_ip
+
+    def terminate(self, signum, frame):
+        # SIGTERM: leave the accept loop the same way Ctrl-C does
+        raise SystemExit(0)
+
+    def lookup_content(self, url_path):
+        # local content first, then whatever the edge cache holds
+        file_info = self.content_index.lookup(url_path)
+        if file_info is None and self.origin_cache is not None:
+            file_info = self.origin_cache.lookup(url_path, fresh=False)
+        return file_info
+
+    def is_confidential(self, path):
+        return '/confidential/' in path or path.startswith('.confidential/')
+
+    @property
+    def content_list(self):
+        # the current published index, swapped atomically by Content_Index
+        return self.content_index.entries
+
+    def load_contents(self, dir):
+        #Create a list of files and stuff that you have
+        return Content_Index(dir).scan()
 
     def listen(self):
+        if self.mode != "asyncio":
+            self.start_workers()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.terminate)
+        try:
+            if self.mode == "select":
+                self.listen_select()
+            elif self.mode == "asyncio":
+                asyncio.run(self.listen_asyncio())
+            else:
+                self.listen_thread()
+        except (KeyboardInterrupt, SystemExit):
+            log.info("Server shutting down...")
+        finally:
+            self.remain_threads = False
+            self.stop_workers()
+            self.content_index.stop()
+            self.mmap_pool.close()
+            self.http_socket.close()
+            if self.log_listener is not None:
+                self.log_listener.stop()
+                self.log_listener = None
+
+    def start_workers(self):
+        for i in range(self.worker_count):
+            worker = threading.Thread(target=self.worker, name=f"vod-worker-{i}")
+            worker.daemon = True
+            worker.start()
+            self.worker_threads.append(worker)
+
+    def stop_workers(self):
+        # connections already queued are still answered, then one sentinel per
+        # worker makes every thread exit; in-flight requests get SHUTDOWN_GRACE
+        deadline = time.monotonic() + SHUTDOWN_GRACE
+        for _ in self.worker_threads:
+            try:
+                self.job_queue.put(None, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for worker in self.worker_threads:
+            worker.join(max(0.0, deadline - time.monotonic()))
+        self.worker_threads = []
+
+    def worker(self):
+        while True:
+            connection = self.job_queue.get()
+            if connection is None:
+                break
+            self.handle_connection(connection)
+
+    def listen_thread(self):
+        # accept loop. Connections wait in a select loop on another thread
+        # until a whole request head has arrived, and again between requests,
+        # so only requests take a worker (or count as load), never a client
+        # that connected and stays silent or an idle keep-alive one
+        keepalive_thread = threading.Thread(target=self.poll_connections, name="vod-keepalive")
+        keepalive_thread.daemon = True
+        keepalive_thread.start()
         while self.remain_threads:
             try:
                 connection_socket, client_address = self.http_socket.accept()
-                print(f"Connection from {client_address}")
+            except OSError as e:
+                self.accept_failed(e)
+                time.sleep(ACCEPT_ERROR_DELAY)
+                continue
+            log.debug("Connection from %s", client_address)
+            self.metrics.connection_accepted()
+            if not self.admit(connection_socket, client_address):
+                continue
+            connection = Client_Connection(connection_socket, client_address, self.traffic_shaper,
+                                           self.connection_limiter)
+            self.park_connection(connection)
 
-                msg_data = b''
-                while True:
-                    chunk = connection_socket.recv(BUFSIZE)
-                    msg_data += chunk
-                    if len(chunk) < BUFSIZE or b"\r\n\r\n" in msg_data:
-                        break
+    def accept_failed(self, e):
+        # EMFILE / ENFILE when out of descriptors, ECONNABORTED when the client
+        # gave up in the backlog: none of them is a reason to stop serving.
+        # Pending clients wait in the backlog until descriptors free up
+        log.warning("accept() failed: %s", e)
+
+    def admit(self, connection_socket, client_address):
+        # admission control at accept time, refused clients get a short 503
+        reason = self.connection_limiter.admit(client_address[0])
+        if reason is None:
+            return True
+        log.debug("Refusing %s: %s", client_address, reason)
+        self.metrics.connection_rejected(reason)
+        self.refuse(Client_Connection(connection_socket, client_address), 503)
+        return False
+
+    def refuse(self, connection, status):
+        # best-effort error response on a connection that is closed right after;
+        # never waits for a client that isn't reading
+        try:
+            connection.set_timeout(0.0)
+            if status == 431:
+                self.generate_response_431('HTTP/1.1', connection)
+            else:
+                self.generate_response_503('HTTP/1.1', connection)
+        except OSError:
+            pass
+        connection.close()
+
+    def listen_select(self):
+        # event loop: accept and read request headers without blocking, then
+        # hand complete requests to the worker pool for the response. Idle
+        # keep-alive connections wait here instead of holding a worker.
+        self.http_socket.setblocking(False)
+        self.poll_connections(self.http_socket)
+
+    def poll_connections(self, listening_socket=None):
+        # the select loop proper; without a listening socket (thread mode) it
+        # only watches the keep-alive connections the workers park
+        selector = selectors.DefaultSelector()
+        self.wakeup_recv.setblocking(False)
+        if listening_socket is not None:
+            selector.register(listening_socket, selectors.EVENT_READ, None)
+        selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
+        pending = set()
 
-                msg_string = msg_data.decode()
-                if msg_string.strip():
-                    self.response(msg_string, connection_socket)
+        try:
+            while self.remain_threads:
+                for key, mask in selector.select(timeout=1.0):
+                    if key.fileobj is listening_socket:
+                        self.accept_select(selector, pending)
+                    elif key.fileobj is self.wakeup_recv:
+                        self.resume_select(selector, pending)
+                    else:
+                        self.read_select(selector, pending, key.fileobj)
+                self.expire_select(selector, pending)
+        finally:
+            for connection in list(pending):
+                selector.unregister(connection)
+                connection.close()
+            selector.close()
 
-                # chunk = connection_socket.recv(BUFSIZE).decode()
-                connection_socket.close()
+    def accept_select(self, selector, pending):
+        try:
+            connection_socket, client_address = self.http_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            # the listening socket stays readable, so pause rather than spin
+            self.accept_failed(e)
+            time.sleep(ACCEPT_ERROR_DELAY)
+            return
+        log.debug("Connection from %s", client_address)
+        self.metrics.connection_accepted()
+        if not self.admit(connection_socket, client_address):
+            return
+        connection = Client_Connection(connection_socket, client_address, self.traffic_shaper,
+                                       self.connection_limiter)
+        connection.set_timeout(0.0)
+        pending.add(connection)
+        selector.register(connection, selectors.EVENT_READ)
 
-            except KeyboardInterrupt:
-                print("Server shutting down...")
-                self.remain_threads = False
-                connection_socket.close()
+    def resume_select(self, selector, pending):
+        # re-arm keep-alive connections that a worker finished with
+        try:
+            self.wakeup_recv.recv(BUFSIZE)
+        except (BlockingIOError, InterruptedError):
+            pass
+        while True:
+            try:
+                connection = self.idle_connections.get_nowait()
+            except queue.Empty:
                 break
-            except Exception as e:
-                print(f"Error in listen: {e}")
+            connection.set_timeout(0.0)
+            connection.last_active = time.monotonic()
+            pending.add(connection)
+            selector.register(connection, selectors.EVENT_READ)
+
+    def read_select(self, selector, pending, connection):
+        try:
+            more = connection.recv_more()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            log.debug("Error reading from %s: %s", connection.address, e)
+            more = False
+
+        if not more:
+            # client went away before finishing its request
+            selector.unregister(connection)
+            pending.discard(connection)
+            connection.close()
+            return
+
+        if b"\r\n\r\n" not in connection.buffer:
+            if connection.header_too_large():
+                self.metrics.connection_rejected("header_too_large")
+                selector.unregister(connection)
+                pending.discard(connection)
+                self.refuse(connection, 431)
+            return
+
+        selector.unregister(connection)
+        pending.discard(connection)
+        if not SHED_LOAD:
+            self.job_queue.put(connection)
+            return
+        try:
+            self.job_queue.put_nowait(connection)
+        except queue.Full:
+            self.metrics.connection_rejected("busy")
+            self.refuse(connection, 503)
+
+    def expire_select(self, selector, pending):
+        # close keep-alive connections that have been idle for too long, and
+        # ones whose request headers are overdue
+        now = time.monotonic()
+        deadline = now - KEEPALIVE_TIMEOUT
+        for connection in [c for c in pending if c.last_active < deadline or c.header_expired(now)]:
+            if connection.header_started is not None:
+                self.metrics.connection_rejected("header_timeout")
+            selector.unregister(connection)
+            pending.discard(connection)
+            connection.close()
+
+    async def listen_asyncio(self):
+        # one coroutine per connection: idle keep-alive clients cost a task, not
+        # a thread. Request handlers (routing, stat, cache fills, compression)
+        # run on a small thread pool and queue their output on the connection,
+        # which the coroutine then writes without blocking the loop.
+        loop = asyncio.get_running_loop()
+        self.http_socket.setblocking(False)
+        self.handler_pool = concurrent.futures.ThreadPoolExecutor(self.worker_count,
+                                                                  thread_name_prefix="vod-handler")
+        if threading.current_thread() is threading.main_thread():
+            # SIGTERM cancels the accept below; open connections then get to finish
+            loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        self.idle_tasks = set()
+        self.handlers_busy = 0
+        tasks = set()
+        try:
+            while self.remain_threads:
                 try:
-                    connection_socket.close()
-                except:
-                    pass
-            
-            #Do stuff here
-        self.http_socket.close()
+                    connection_socket, client_address = await loop.sock_accept(self.http_socket)
+                except asyncio.CancelledError:
+                    log.info("Server shutting down...")
+                    break
+                except OSError as e:
+                    self.accept_failed(e)
+                    try:
+                        await asyncio.sleep(ACCEPT_ERROR_DELAY)
+                    except asyncio.CancelledError:
+                        log.info("Server shutting down...")
+                        break
+                    continue
+                log.debug("Connection from %s", client_address)
+                self.metrics.connection_accepted()
+                connection_socket.setblocking(False)
+                if not self.admit(connection_socket, client_address):
+                    continue
+                connection = Async_Connection(connection_socket, client_address, self.traffic_shaper,
+                                              self.connection_limiter)
+                task = asyncio.create_task(self.serve_asyncio(loop, connection))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            self.remain_threads = False
+            for task in list(self.idle_tasks):
+                task.cancel()
+            if tasks:
+                await asyncio.wait(list(tasks), timeout=SHUTDOWN_GRACE)
+            for task in list(tasks):
+                task.cancel()
+            self.handler_pool.shutdown(wait=False, cancel_futures=True)
+
+    async def serve_asyncio(self, loop, connection):
+        # the asyncio counterpart of serve_requests
+        task = asyncio.current_task()
+        try:
+            while True:
+                msg_data = connection.next_request()
+                if msg_data is None:
+                    if connection.header_too_large():
+                        self.metrics.connection_rejected("header_too_large")
+                        self.generate_response_431('HTTP/1.1', connection)
+                        await connection.flush(loop)
+                        return
+                    if not self.remain_threads and connection.requests_served:
+                        return
+                    timeout = connection.read_timeout()
+                    if timeout <= 0:
+                        self.metrics.connection_rejected("header_timeout")
+                        return
+                    # waiting for the client: may be cancelled on shutdown
+                    self.idle_tasks.add(task)
+                    try:
+                        received = await asyncio.wait_for(loop.sock_recv_into(connection.socket, connection.chunk),
+                                                          timeout)
+                    except asyncio.TimeoutError:
+                        if connection.header_started is not None:
+                            self.metrics.connection_rejected("header_timeout")
+                        return
+                    finally:
+                        self.idle_tasks.discard(task)
+                    if not connection.add_received(received):
+                        return
+                    continue
+
+                connection.keep_alive = False
+                if SHED_LOAD and self.handlers_busy >= self.worker_count * 2:
+                    # as many requests waiting for a handler as the thread modes queue
+                    self.metrics.connection_rejected("busy")
+                    self.generate_response_503('HTTP/1.1', connection)
+                    await connection.flush(loop)
+                    return
+                if msg_data.strip():
+                    connection.status = None
+                    connection.first_byte_at = None
+                    bytes_before = connection.bytes_sent
+                    started = time.perf_counter()
+                    self.handlers_busy += 1
+                    try:
+                        await loop.run_in_executor(self.handler_pool, self.response, msg_data, connection)
+                    finally:
+                        self.handlers_busy -= 1
+                    await connection.flush(loop)
+                    if connection.status is not None:
+                        first_byte = connection.first_byte_at - started if connection.first_byte_at else None
+                        self.metrics.observe(connection.status, connection.bytes_sent - bytes_before,
+                                             first_byte, time.perf_counter() - started)
+                connection.requests_served += 1
+                if not connection.keep_alive or not self.remain_threads:
+                    return
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # a write stalled past SEND_TIMEOUT, or shutdown
+            pass
+        except OSError as e:
+            log.debug("Error serving %s: %s", connection.address, e)
+        except Exception as e:
+            log.warning("Error handling %s: %s", connection.address, e)
+        finally:
+            connection.close()
+
+    def park_connection(self, connection):
+        # give an idle keep-alive connection back to the select loop
+        self.idle_connections.put(connection)
+        try:
+            self.wakeup_send.send(b'\0')
+        except OSError:
+            pass
+
+    def handle_connection(self, connection):
+        keep_open = False
+        try:
+            keep_open = self.serve_requests(connection)
+        except socket.timeout:
+            # a stalled write
+            pass
+        except Exception as e:
+            log.warning("Error handling %s: %s", connection.address, e)
+        finally:
+            if keep_open:
+                self.park_connection(connection)
+            else:
+                connection.close()
+
+    def serve_requests(self, connection):
+        # answer requests on this connection in order (pipelined requests are
+        # already sitting in the buffer). Returns True if the connection should
+        # be parked in the select loop instead of closed. Once the server is
+        # stopping, the request at hand is finished and the connection closed.
+        while True:
+            msg_data = connection.next_request()
+            if msg_data is None:
+                if connection.header_too_large():
+                    self.metrics.connection_rejected("header_too_large")
+                    connection.set_timeout(SEND_TIMEOUT)
+                    self.generate_response_431('HTTP/1.1', connection)
+                    return False
+                if not self.remain_threads and connection.requests_served:
+                    return False
+                # the rest of the next request is awaited in the select loop, not here
+                return True
+
+            connection.keep_alive = False
+            connection.set_timeout(SEND_TIMEOUT)
+            if msg_data.strip():
+                connection.status = None
+                connection.first_byte_at = None
+                bytes_before = connection.bytes_sent
+                started = time.perf_counter()
+                self.response(msg_data, connection)
+                if connection.status is not None:
+                    first_byte = connection.first_byte_at - started if connection.first_byte_at else None
+                    self.metrics.observe(connection.status, connection.bytes_sent - bytes_before,
+                                         first_byte, time.perf_counter() - started)
+            connection.requests_served += 1
+            if not connection.keep_alive or not self.remain_threads:
+                return False
             
-    def response(self, msg_string, connection_socket):
+    def response(self, msg_data, connection_socket):
         """Process HTTP request and generate appropriate response"""
         http_version = 'HTTP/1.1'  # Default version
         try:
-            lines = msg_string.split('\r\n')
+            lines = msg_data.split(b'\r\n')
             if not lines or not lines[0].strip():
-                print("Empty or invalid request")
+                log.debug("Empty or invalid request")
                 return
                 
             # Parse request line
-            request_line = lines[0].strip().split()
+            request_line = lines[0].split()
             if len(request_line) < 2:
-                print(f"Invalid request line: {lines[0]}")
+                log.debug("Invalid request line: %s", lines[0])
                 self.generate_response_404(http_version, connection_socket)
                 return
             
-            method = request_line[0]
-            uri = request_line[1]
+            method = request_line[0].decode('latin-1')
+            uri = request_line[1].decode('latin-1')
             # HTTP version is optional in some cases
             if len(request_line) >= 3:
-                http_version = request_line[2]
+                http_version = request_line[2].decode('latin-1')
             
-            print(f"Request: {method} {uri} {http_version}")
+            log.debug("Request: %s %s %s", method, uri, http_version)
+
+            # Parse headers for Range requests and connection management
+            headers = self.eval_commands(lines)
+            self.update_keep_alive(http_version, headers, connection_socket)
             
             # Only support GET method
             if method.upper() != 'GET':
                 self.generate_response_404(http_version, connection_socket)
                 return
             
-            # Parse URI and remove query parameters
-            parsed_uri = urllib.parse.urlparse(uri)
-            path = parsed_uri.path
+            # Remove query parameters and fragment, decode %-escapes
+            path, _, query = uri.partition('#')[0].partition('?')
+            # Absolute-form target (RFC 9112 3.2.2): drop scheme and authority
+            if '://' in path and not path.startswith('/'):
+                path = '/' + path.split('://', 1)[1].partition('/')[2]
+            if '%' in path:
+                path = urllib.parse.unquote(path)
             
             # Handle root path
             if path == '/' or path == '':
                 path = '/index.html'
+
+            connection_socket.request_path = path
+
+            if path == METRICS_PATH:
+                self.send_generated(http_version, "text/plain; version=0.0.4",
+                                    self.metrics.render(self), connection_socket)
+                return
+
+            if path == STREAMS_PATH:
+                if connection_socket.address[0] not in STREAMS_ALLOWED_IPS:
+                    log.info("Access denied to %s from %s", path, connection_socket.address[0])
+                    self.generate_response_403(http_version, connection_socket)
+                    return
+                self.send_generated(http_version, "application/json",
+                                    json.dumps(self.traffic_shaper.stream_rates()).encode(), connection_socket)
+                return
+
+            if path == LISTING_PATH:
+                self.serve_listing(http_version, query, connection_socket)
+                return
+
+            if SEGMENTS and path.startswith(SEGMENT_PREFIX):
+                self.serve_segments(http_version, path, headers, connection_socket)
+                return
             
-            # Parse headers for Range requests
-            headers = self.eval_commands(lines)
-            
-            # Check if file exists
-            if path not in self.content_list:
-                print(f"File not found: {path}")
-                print(f"Available files: {list(self.content_list.keys())}")
-                print(f"{self.content_list}")
+            # Check if file exists, locally or in the edge cache
+            file_info = self.content_index.lookup(path)
+            if file_info is None and self.origin_cache is not None and not self.is_confidential(path):
+                file_info = self.origin_cache.lookup(path)
+                if file_info is None:
+                    if self.serve_origin(http_version, path, headers, connection_socket):
+                        return
+                    file_info = self.origin_cache.lookup(path, fresh=False)
+            if file_info is None:
+                log.debug("File not found: %s", path)
                 self.generate_response_404(http_version, connection_socket)
                 return
             
-            if '/confidential/' in path or path.startswith('.confidential/'):
-                print(f"Access denied to confidential file: {path}")
+            if self.is_confidential(path):
+                log.info("Access denied to confidential file: %s", path)
                 self.generate_response_403(http_version, connection_socket)
                 return
-
-            file_info = self.content_list[path]
             
             # Check file size limit
-            if file_info['size'] > LARGEST_CONTENT_SIZE:
-                print(f"File too large: {file_info['size']} bytes")
+            if LARGEST_CONTENT_SIZE is not None and file_info['size'] > LARGEST_CONTENT_SIZE:
+                log.debug("File too large: %s bytes", file_info['size'])
                 self.generate_response_403(http_version, connection_socket)
                 return
             
-            # Handle Range requests (partial content)
-            if 'Range' in headers:
+            # Conditional requests: nothing changed, nothing to send
+            etag = self.not_modified_etag(headers, file_info)
+            if etag is not None:
+                self.generate_response_304(http_version, file_info, etag, connection_socket)
+                return
+
+            # Handle Range requests (partial content), unless If-Range says the
+            # client's copy is stale, in which case it gets the whole file
+            if 'Range' in headers and self.if_range_matches(headers, file_info):
                 self.generate_response_206(http_version, path, file_info['type'], headers, connection_socket)
             else:
-                self.generate_response_200(http_version, path, file_info['type'], connection_socket)
+                self.generate_response_200(http_version, path, file_info['type'], connection_socket, headers)
                 
         except IndexError as e:
-            print(f"Index error parsing request: {e}")
-            print(f"Request string: {repr(msg_string)}")
+            connection_socket.keep_alive = False
+            log.warning("Index error parsing request: %s (request %r)", e, msg_data)
             self.generate_response_404(http_version, connection_socket)
         except Exception as e:
-            print(f"Error processing request: {e}")
-            print(f"Request string: {repr(msg_string)}")
+            connection_socket.keep_alive = False
+            log.warning("Error processing request: %s (request %r)", e, msg_data)
             self.generate_response_404(http_version, connection_socket)
 
     
+    def update_keep_alive(self, http_version, headers, connection_socket):
+        # HTTP/1.1 keeps the connection open unless asked not to, HTTP/1.0 only on request
+        connection_header = headers.get('Connection', '').lower()
+        if http_version == 'HTTP/1.1':
+            keep_alive = 'close' not in connection_header
+        else:
+            keep_alive = 'keep-alive' in connection_header
+
+        if connection_socket.requests_served + 1 >= KEEPALIVE_MAX_REQUESTS:
+            keep_alive = False
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            # we don't decode chunked request bodies, so we can't find the next request
+            keep_alive = False
+
+        try:
+            connection_socket.body_remaining = max(0, int(headers.get('Content-Length', 0)))
+        except ValueError:
+            keep_alive = False
+        connection_socket.keep_alive = keep_alive
+
+    def not_modified_etag(self, headers, file_info):
+        # the ETag for a 304 (that of the representation the client holds, so
+        # an encoded one when it matched) or None if the full response is due.
+        # If-None-Match wins over If-Modified-Since when both are sent (RFC 7232)
+        if_none_match = headers.get('If-None-Match')
+        if if_none_match is not None:
+            if if_none_match.strip() == '*':
+                return file_info['etag']
+            # weak comparison: W/ prefixes don't matter here
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+            for tag in tags:
+                if tag == file_info['etag'] or tag in self.encoded_etags(file_info):
+                    return tag
+            return None
+
+        if_modified_since = headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            since = self.parse_http_date(if_modified_since)
+            if since is not None and file_info['mtime_ns'] // 1000000000 <= since:
+                return file_info['etag']
+        return None
+
+    def if_range_matches(self, headers, file_info):
+        # If-Range holds either an ETag (compared strongly) or a date that has
+        # to be exactly our Last-Modified
+        if_range = headers.get('If-Range')
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            return if_range == file_info['etag']
+        since = self.parse_http_date(if_range)
+        return since is not None and since == file_info['mtime_ns'] // 1000000000
+
+    def parse_http_date(self, value):
+        # HTTP-date to a unix timestamp in whole seconds, None if unparseable
+        try:
+            return int(email.utils.parsedate_to_datetime(value).timestamp())
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return None
+
+    def date_header(self):
+        # the Date header only changes once a second, so format it once a second
+        now = int(time.time())
+        second, header = self.cached_date
+        if second != now:
+            header = time.strftime("Date: %a, %d %b %Y %H:%M:%S GMT\r\n", time.gmtime(now)).encode()
+            self.cached_date = (now, header)
+        return header
+
+    def build_headers(self, http_version, status, connection_socket, *header_blocks):
+        # status line + Date + Server + the given pre-rendered blocks + Connection
+        status_line = self.status_lines.get((http_version, status))
+        if status_line is None:
+            status_line = f"{http_version} {status} {STATUS_REASONS[status]}\r\n".encode('latin-1')
+            self.status_lines[(http_version, status)] = status_line
+        connection_header = CONNECTION_KEEP_ALIVE if connection_socket.keep_alive else CONNECTION_CLOSE
+        connection_socket.status = status
+        return b"".join((status_line, self.date_header(), SERVER_HEADER) + header_blocks + (connection_header, b"\r\n"))
+
+    def validator_headers(self, file_info):
+        # Last-Modified / ETag / Cache-Control, rendered once per file version
+        block = file_info.get('validator_headers')
+        if block is None:
+            block = (f"Last-Modified: {file_info['modified'].strftime('%a, %d %b %Y %H:%M:%S GMT')}\r\n"
+                     f"ETag: {file_info['etag']}\r\n")
+            cache_control = CACHE_CONTROL_BY_TYPE.get(file_info['type'], CACHE_CONTROL)
+            if cache_control:
+                block += f"Cache-Control: {cache_control}\r\n"
+            block = block.encode('latin-1')
+            file_info['validator_headers'] = block
+        return block
+
+    def file_headers(self, file_info, content_length=None):
+        # entity headers of a file; the common full-size case including
+        # Content-Length is rendered once and reused for every 200
+        block = file_info.get('file_headers')
+        if block is None:
+            block = (f"Content-Type: {file_info['type']}\r\n".encode('latin-1')
+                     + self.validator_headers(file_info) + b"Accept-Ranges: bytes\r\n")
+            if self.is_compressible(file_info):
+                block += b"Vary: Accept-Encoding\r\n"
+            file_info['file_headers'] = block
+        if content_length is None or content_length == file_info['size']:
+            full = file_info.get('full_headers')
+            if full is None:
+                full = b"Content-Length: %d\r\n" % file_info['size'] + block
+                file_info['full_headers'] = full
+            return full
+        return b"Content-Length: %d\r\n" % content_length + block
+
+    def generate_response_304(self, http_version, file_info, etag, connection_socket):
+        #Generate Response and Send
+
+        block = self.validator_headers(file_info)
+        if etag != file_info['etag']:
+            block = block.replace(file_info['etag'].encode('latin-1'), etag.encode('latin-1'))
+        if self.is_compressible(file_info):
+            # the same Vary the 200 carries, so caches key the 304 the same way
+            block += b"Vary: Accept-Encoding\r\n"
+        response_headers = self.build_headers(http_version, 304, connection_socket, block)
+        connection_socket.sendall(response_headers)
+
     def generate_response_404(self, http_version, connection_socket):
         #Generate Response and Send
-        
-        response_body = """<!DOCTYPE html>
-<html>
-<head><title>404 Not Found</title></head>
-<body><h1>404 Not Found</h1><p>The requested resource was not found on this server.</p></body>
-</html>"""
-        
-        response_headers = f"""{http_version} 404 Not Found\r
-Date: {datetime.datetime.now(datetime.UTC).strftime('%a, %d %b %Y %H:%M:%S GMT')}\r
-Server: Simple-File-Server/1.0\r
-Content-Type: text/html\r
-Content-Length: {len(response_body)}\r
-Connection: close\r
-\r
-"""
-
-        response = response_headers + response_body
-        connection_socket.send(response.encode())
-        
-        # return response
+
+        response_headers = self.build_headers(http_version, 404, connection_socket,
+                                              b"Content-Type: text/html\r\nContent-Length: %d\r\n" % len(NOT_FOUND_BODY))
+        connection_socket.sendall(response_headers + NOT_FOUND_BODY)
 
     def generate_response_403(self, http_version, connection_socket):
         #Generate Response and Send
 
-        response_body = """<!DOCTYPE html>
-<html>
-<head><title>403 Forbidden</title></head>
-<body><h1>403 Forbidden</h1><p>Access to this resource is forbidden.</p></body>
-</html>"""
-        
-        response_headers = f"""{http_version} 403 Forbidden\r
-Date: {datetime.datetime.now(datetime.UTC).strftime('%a, %d %b %Y %H:%M:%S GMT')}\r
-Server: Simple-File-Server/1.0\r
-Content-Type: text/html\r
-Content-Length: {len(response_body)}\r
-Connection: close\r
-\r
-"""
-        
-        response = response_headers + response_body
-        connection_socket.send(response.encode())
-        
-        # return response
+        response_headers = self.build_headers(http_version, 403, connection_socket,
+                                              b"Content-Type: text/html\r\nContent-Length: %d\r\n" % len(FORBIDDEN_BODY))
+        connection_socket.sendall(response_headers + FORBIDDEN_BODY)
     
-    def generate_response_200(self, http_version, file_idx, file_type, connection_socket):
+    def generate_response_502(self, http_version, connection_socket):
+        #Generate Response and Send
+
+        response_headers = self.build_headers(http_version, 502, connection_socket,
+                                              b"Content-Type: text/html\r\nContent-Length: %d\r\n" % len(BAD_GATEWAY_BODY))
+        connection_socket.sendall(response_headers + BAD_GATEWAY_BODY)
+
+    def generate_response_415(self, http_version, connection_socket):
+        #Generate Response and Send
+
+        response_headers = self.build_headers(http_version, 415, connection_socket,
+                                              b"Content-Type: text/html\r\nContent-Length: %d\r\n" % len(UNSUPPORTED_MEDIA_BODY))
+        connection_socket.sendall(response_headers + UNSUPPORTED_MEDIA_BODY)
+
+    def generate_response_431(self, http_version, connection_socket):
+        #Generate Response and Send
+
+        connection_socket.keep_alive = False
+        response_headers = self.build_headers(http_version, 431, connection_socket,
+                                              b"Content-Type: text/html\r\nContent-Length: %d\r\n" % len(HEADERS_TOO_LARGE_BODY))
+        connection_socket.sendall(response_headers + HEADERS_TOO_LARGE_BODY)
+
+    def generate_response_503(self, http_version, connection_socket):
+        #Generate Response and Send
+
+        connection_socket.keep_alive = False
+        response_headers = self.build_headers(http_version, 503, connection_socket,
+                                              b"Content-Type: text/html\r\nContent-Length: %d\r\n" % len(UNAVAILABLE_BODY),
+                                              b"Retry-After: %d\r\n" % RETRY_AFTER)
+        connection_socket.sendall(response_headers + UNAVAILABLE_BODY)
+
+    def generate_response_200(self, http_version, file_idx, file_type, connection_socket, request_headers=None):
         #Generate Response and Send
         
         try:
-            file_info = self.content_list[file_idx]
-            
-            with open(file_info['path'], 'rb') as f:
-                file_content = f.read()
-            
-            response_headers = f"""{http_version} 200 OK\r
-Date: {datetime.datetime.now(datetime.UTC).strftime('%a, %d %b %Y %H:%M:%S GMT')}\r
-Server: Simple-File-Server/1.0\r
-Content-Type: {file_type}\r
-Content-Length: {len(file_content)}\r
-Last-Modified: {file_info['modified'].strftime('%a, %d %b %Y %H:%M:%S GMT')}\r
-Accept-Ranges: bytes\r
-Connection: close\r
-\r
-"""
-            
-            # Send headers
-            connection_socket.send(response_headers.encode())
-            # Send file content
-            connection_socket.send(file_content)
-            
+            file_info = self.lookup_content(file_idx)
+            if request_headers is not None and 'Accept-Encoding' in request_headers:
+                if self.send_encoded(http_version, file_idx, file_info, request_headers['Accept-Encoding'],
+                                     connection_socket):
+                    return
+            body, f, file_size = self.open_content(file_info)
         except Exception as e:
-            print(f"Error serving file: {e}")
+            log.warning("Error opening file: %s", e)
             self.generate_response_404(http_version, connection_socket)
+            return
+
+        try:
+            response_headers = self.build_headers(http_version, 200, connection_socket,
+                                                  self.file_headers(file_info, file_size))
+            
+            # Send headers and file content
+            self.send_content(connection_socket, response_headers, body, f, 0, file_size)
+        except OSError as e:
+            # headers may already be out, all we can do is drop the connection
+            log.warning("Error serving file: %s", e)
+            connection_socket.keep_alive = False
+        finally:
+            if f is not None:
+                f.close()
 
         # return response
 
+    def serve_origin(self, http_version, path, headers, connection_socket):
+        # edge cache miss: join or start the origin fetch of path. Returns
+        # False once the file is stored (the caller then serves it like local
+        # content), True if the response was sent here, streamed from the
+        # download in progress. In asyncio mode the streamed body only goes
+        # out when the handler returns, i.e. after the download.
+        meta = self.origin_cache.lookup_sliced(path)
+        if meta is not None:
+            self.serve_sliced(http_version, path, headers, meta, connection_socket)
+            return True
+        fetch = self.origin_cache.fetch(path)
+        if fetch is None:
+            meta = self.origin_cache.lookup_sliced(path)
+            if meta is None:
+                return False
+            self.serve_sliced(http_version, path, headers, meta, connection_socket)
+            return True
+        if not fetch.wait_headers(ORIGIN_TIMEOUT) or fetch.status is None:
+            self.generate_response_502(http_version, connection_socket)
+            return True
+        if fetch.meta is not None:
+            self.serve_sliced(http_version, path, headers, fetch.meta, connection_socket)
+            return True
+        if fetch.status == 304:
+            return False
+        if fetch.status in (403, 404, 410):
+            if fetch.status == 403:
+                self.generate_response_403(http_version, connection_socket)
+            else:
+                self.generate_response_404(http_version, connection_socket)
+            return True
+        if fetch.status != 200:
+            self.generate_response_502(http_version, connection_socket)
+            return True
+
+        try:
+            if fetch.size is None:
+                # no length to announce before the end: wait for the whole file
+                fetch.wait_done(ORIGIN_TIMEOUT)
+            if fetch.done and not fetch.error and self.origin_cache.lookup(path, fresh=False) is not None:
+                return False
+            if fetch.size is None:
+                raise OSError(fetch.error or "file was not stored")
+        except OSError as e:
+            log.warning("Error pulling %s: %s", path, e)
+            self.generate_response_502(http_version, connection_socket)
+            return True
+
+        file_info = fetch.file_info()
+        start, count, status = 0, fetch.size, 200
+        if 'Range' in headers:
+            ranges = self.parse_range_header(headers['Range'], fetch.size)
+            if ranges is not None and len(ranges) == 1:
+                start, end = ranges[0]
+                count, status = end - start + 1, 206
+        if status == 206:
+            response_headers = self.build_headers(http_version, 206, connection_socket,
+                                                  b"Content-Range: bytes %d-%d/%d\r\n" % (start, start + count - 1, fetch.size),
+                                                  self.file_headers(file_info, count))
+        else:
+            response_headers = self.build_headers(http_version, 200, connection_socket,
+                                                  self.file_headers(file_info, count))
+
+        try:
+            connection_socket.sendall(response_headers)
+            self.stream_fetch(connection_socket, fetch, start, count)
+        except OSError as e:
+            log.warning("Error streaming %s: %s", path, e)
+            connection_socket.keep_alive = False
+        return True
+
+    def stream_fetch(self, connection_socket, fetch, offset, count):
+        # send count bytes at offset of an Origin_Fetch's file as they arrive
+        if not fetch.wait_headers(ORIGIN_TIMEOUT):
+            raise OSError(f"origin did not answer for {fetch.url_path}")
+        if fetch.error is not None:
+            raise OSError(f"origin fetch of {fetch.url_path} failed: {fetch.error}")
+        f = fetch.open_reader()
+        try:
+            end = offset + count
+            while offset < end:
+                available = fetch.wait_for(offset, ORIGIN_TIMEOUT)
+                piece = min(available, end) - offset
+                self.send_file_range(connection_socket, f, offset, piece)
+                offset += piece
+        finally:
+            f.close()
+
+    def serve_sliced(self, http_version, path, headers, meta, connection_socket):
+        # a large edge-cached file: only the slices the response covers are
+        # read (and fetched from the origin if missing), never the whole file
+        file_info = self.origin_cache.sliced_info(meta)
+        etag = self.not_modified_etag(headers, file_info)
+        if etag is not None:
+            self.generate_response_304(http_version, file_info, etag, connection_socket)
+            return
+
+        ranges = None
+        if 'Range' in headers and self.if_range_matches(headers, file_info):
+            ranges = self.parse_range_header(headers['Range'], meta['size'])
+            if ranges == []:
+                response_headers = self.build_headers(http_version, 416, connection_socket,
+                                                      b"Content-Range: bytes */%d\r\nContent-Length: 0\r\n" % meta['size'])
+                connection_socket.sendall(response_headers)
+                return
+
+        # a read continuing where the last one on this connection stopped
+        # counts as sequential playback and also reads ahead past its end
+        first_slice = (ranges[0][0] if ranges else 0) // meta['slice_size']
+        cursor = connection_socket.slice_cursor
+        sequential = cursor is not None and cursor[0] == path and first_slice - cursor[1] in (0, 1)
+
+        try:
+            if not ranges:
+                response_headers = self.build_headers(http_version, 200, connection_socket,
+                                                      self.file_headers(file_info))
+                connection_socket.sendall(response_headers)
+                self.send_slices(connection_socket, meta, 0, meta['size'], sequential)
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                response_headers = self.build_headers(http_version, 206, connection_socket,
+                                                      b"Content-Range: bytes %d-%d/%d\r\n" % (start, end, meta['size']),
+                                                      self.file_headers(file_info, end - start + 1))
+                connection_socket.sendall(response_headers)
+                self.send_slices(connection_socket, meta, start, end - start + 1, sequential)
+            else:
+                self.send_multipart_ranges(http_version, file_info, file_info['type'], ranges, meta['size'],
+                                           None, None, connection_socket,
+                                           send_range=lambda start, count: self.send_slices(
+                                               connection_socket, meta, start, count, False))
+        except OSError as e:
+            log.warning("Error serving %s from slices: %s", path, e)
+            connection_socket.keep_alive = False
+
+    def send_slices(self, connection_socket, meta, offset, count, sequential):
+        slice_size = meta['slice_size']
+        last_slice = (offset + count - 1) // slice_size
+        if sequential:
+            last_slice = self.origin_cache.slice_count(meta) - 1
+        while count > 0:
+            number = offset // slice_size
+            # keep the next slices in flight while this one is sent
+            for ahead in range(number + 1, min(number + ORIGIN_SLICE_READAHEAD, last_slice) + 1):
+                self.origin_cache.prefetch(meta, ahead)
+            source = self.origin_cache.get_slice(meta, number)
+            slice_offset = offset - number * slice_size
+            piece = min(count, self.origin_cache.slice_length(meta, number) - slice_offset)
+            if isinstance(source, Origin_Fetch):
+                self.stream_fetch(connection_socket, source, slice_offset, piece)
+            else:
+                with open(source, 'rb') as f:
+                    self.send_file_range(connection_socket, f, slice_offset, piece)
+            connection_socket.slice_cursor = (meta['url'], number)
+            offset += piece
+            count -= piece
+
+    def serve_listing(self, http_version, query, connection_socket):
+        # LISTING_PATH: one page of the content under a prefix, as JSON
+        params = {key: values[-1] for key, values in urllib.parse.parse_qs(query).items()}
+        prefix = params.get('prefix', '/')
+        if not prefix.startswith('/'):
+            prefix = '/' + prefix
+        sort = params.get('sort', 'path')
+        if sort not in ('path', 'size', 'mtime'):
+            sort = 'path'
+        descending = params.get('order') == 'desc'
+        mime = params.get('type') or None
+        try:
+            limit = min(LISTING_MAX_LIMIT, max(1, int(params.get('limit', LISTING_DEFAULT_LIMIT))))
+        except ValueError:
+            limit = LISTING_DEFAULT_LIMIT
+
+        total, page, next_cursor = self.content_listing.query(prefix, sort, descending, mime, limit,
+                                                              params.get('cursor'))
+        body = json.dumps({
+            "prefix": prefix,
+            "sort": sort,
+            "order": "desc" if descending else "asc",
+            "type": mime,
+            "total": total,
+            "items": [{
+                "path": url_path,
+                "size": file_info['size'],
+                "modified": file_info['modified'].strftime('%Y-%m-%dT%H:%M:%SZ'),
+                "type": file_info['type'],
+                "etag": file_info['etag'],
+            } for url_path, file_info in page],
+            "next": next_cursor,
+        }).encode()
+        self.send_generated(http_version, "application/json", body, connection_socket)
+
+    def serve_segments(self, http_version, path, headers, connection_socket):
+        # /_segments/<file>/index.m3u8   media playlist of one file
+        # /_segments/<file>/master.m3u8  variants: <name>_<kbps>k.<ext> files next to it
+        # /_segments/<file>/<n><ext>     segment n, a ranged read of <file>
+        source, _, name = path[len(SEGMENT_PREFIX) - 1:].rpartition('/')
+        file_info = self.content_index.lookup(source)
+        if file_info is None or not source:
+            self.generate_response_404(http_version, connection_socket)
+            return
+        if self.is_confidential(source):
+            log.info("Access denied to confidential file: %s", source)
+            self.generate_response_403(http_version, connection_socket)
+            return
+        if not self.segment_index.can_segment(file_info):
+            self.generate_response_415(http_version, connection_socket)
+            return
+
+        segment_ext = os.path.splitext(source)[1]
+        if name == "index.m3u8":
+            table = self.segment_index.get(file_info)
+            self.send_generated(http_version, "application/vnd.apple.mpegurl",
+                                self.segment_index.playlist(table, segment_ext), connection_socket)
+        elif name == "master.m3u8":
+            self.send_generated(http_version, "application/vnd.apple.mpegurl",
+                                self.master_playlist(source), connection_socket)
+        elif name.endswith(segment_ext) and name[:-len(segment_ext)].isdigit():
+            table = self.segment_index.get(file_info)
+            number = int(name[:-len(segment_ext)])
+            if number >= len(table['segments']):
+                self.generate_response_404(http_version, connection_socket)
+                return
+            offset, length, duration = table['segments'][number]
+            self.send_segment(http_version, file_info, offset, length, connection_socket)
+        else:
+            self.generate_response_404(http_version, connection_socket)
+
+    def master_playlist(self, source):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+        for candidate, file_info in self.renditions(source):
+            table = self.segment_index.get(file_info)
+            lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={self.segment_index.bandwidth(table)}")
+            lines.append(urllib.parse.quote(f"{SEGMENT_PREFIX}{candidate.lstrip('/')}/index.m3u8"))
+        return ("\n".join(lines) + "\n").encode()
+
+    def renditions(self, source):
+        # (path, file info) of every rendition of source's title, in path
+        # order. The grouping is worked out once per published content index
+        # (swapped as a whole, so its identity is the version), not per request
+        entries = self.content_index.entries
+        groups = self.rendition_groups
+        if groups is None or groups['source'] is not entries:
+            titles = {}
+            for path in sorted(entries):
+                titles.setdefault(self.rendition_title(path), []).append((path, entries[path]))
+            groups = self.rendition_groups = {'source': entries, 'titles': titles}
+        return groups['titles'].get(self.rendition_title(source), [])
+
+    def rendition_title(self, path):
+        # renditions of one title are named <name>_<kbps>k<ext> in the same directory
+        directory, _, filename = path.rpartition('/')
+        stem, ext = os.path.splitext(filename)
+        if stem.endswith('k') and stem.rsplit('_', 1)[-1][:-1].isdigit():
+            stem = stem.rsplit('_', 1)[0]
+        return directory, stem, ext
+
+    def send_generated(self, http_version, content_type, body, connection_socket):
+        response_headers = self.build_headers(http_version, 200, connection_socket,
+                                              f"Content-Type: {content_type}\r\n".encode('latin-1'),
+                                              b"Cache-Control: no-cache\r\nContent-Length: %d\r\n" % len(body))
+        connection_socket.sendall(response_headers + body)
+
+    def send_segment(self, http_version, file_info, offset, length, connection_socket):
+        try:
+            body, f, file_size = self.open_content(file_info, ranged=True)
+        except Exception as e:
+            log.warning("Error opening file: %s", e)
+            self.generate_response_404(http_version, connection_socket)
+            return
+
+        try:
+            etag = file_info['etag'][:-1] + f"-s{offset:x}" + '"'
+            response_headers = self.build_headers(http_version, 200, connection_socket,
+                                                  f"Content-Type: video/mp2t\r\nETag: {etag}\r\n".encode('latin-1'),
+                                                  b"Content-Length: %d\r\n" % length)
+            if offset + length > file_size:
+                raise OSError("file shrank under its segment index")
+            self.send_content(connection_socket, response_headers, body, f, offset, length)
+        except OSError as e:
+            log.warning("Error serving segment: %s", e)
+            connection_socket.keep_alive = False
+        finally:
+            if f is not None:
+                f.close()
+
+    def is_compressible(self, file_info):
+        file_type = file_info['type']
+        return COMPRESSION and (file_type.startswith('text/') or file_type in COMPRESSIBLE_TYPES)
+
+    def parse_accept_encoding(self, accept_encoding):
+        # codings the client accepts (q > 0); "*" stands for any coding not listed
+        accepted = set()
+        rejected = set()
+        for item in accept_encoding.split(','):
+            coding, _, params = item.partition(';')
+            coding = coding.strip().lower()
+            if not coding:
+                continue
+            q = 1.0
+            for param in params.split(';'):
+                name, _, value = param.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            (accepted if q > 0 else rejected).add(coding)
+        if '*' in accepted:
+            accepted.update(c for c, _ in ENCODING_SUFFIXES if c not in rejected)
+        return accepted
+
+    def encoded_etags(self, file_info):
+        # each Content-Encoding is a different representation, so it gets its own ETag
+        return [file_info['etag'][:-1] + '-' + coding + '"' for coding, _ in ENCODING_SUFFIXES]
+
+    def encoded_variant(self, url_path, file_info, accept_encoding):
+        # pick a compressed representation: a precompressed sidecar (file.gz /
+        # file.br next to the file and at least as new) if there is one,
+        # otherwise compress on the fly and keep the result in memory.
+        # Returns (coding, sidecar file_info or None, body bytes or None) or None.
+        if not self.is_compressible(file_info) or file_info['size'] < COMPRESS_MIN_SIZE:
+            return None
+        accepted = self.parse_accept_encoding(accept_encoding)
+        if not accepted:
+            return None
+
+        for coding, suffix in ENCODING_SUFFIXES:
+            if coding in accepted:
+                sidecar = self.content_index.lookup(url_path + suffix)
+                if sidecar is not None and sidecar['mtime_ns'] >= file_info['mtime_ns']:
+                    return coding, sidecar, None
+
+        if file_info['size'] > COMPRESS_MAX_SIZE:
+            return None
+        for coding, _ in ENCODING_SUFFIXES:
+            if coding not in accepted or (coding == 'br' and brotli is None):
+                continue
+            key = (file_info['path'], coding)
+            body = self.compressed_cache.lookup(key, file_info['mtime_ns'])
+            if body is None:
+                with open(file_info['path'], 'rb') as f:
+                    data = f.read(COMPRESS_MAX_SIZE + 1)
+                if coding == 'br':
+                    body = brotli.compress(data)
+                else:
+                    body = gzip.compress(data, COMPRESS_LEVEL, mtime=0)
+                if len(body) >= len(data):
+                    # didn't help, remember that with an empty entry
+                    body = b''
+                self.compressed_cache.store(key, body, file_info['mtime_ns'])
+            if not body:
+                return None
+            return coding, None, body
+        return None
+
+    def send_encoded(self, http_version, url_path, file_info, accept_encoding, connection_socket):
+        # returns False if the identity body should be sent instead
+        variant = self.encoded_variant(url_path, file_info, accept_encoding)
+        if variant is None:
+            return False
+        coding, sidecar, body = variant
+
+        f = None
+        size = len(body) if body is not None else 0
+        if sidecar is not None:
+            try:
+                body, f, size = self.open_content(sidecar)
+            except OSError:
+                # sidecar vanished, serve the plain file
+                return False
+
+        try:
+            block = file_info.get('encoded_headers_' + coding)
+            if block is None:
+                etag = file_info['etag'][:-1] + '-' + coding + '"'
+                block = (f"Content-Type: {file_info['type']}\r\n"
+                         f"Content-Encoding: {coding}\r\n"
+                         "Vary: Accept-Encoding\r\n").encode('latin-1')
+                block += self.validator_headers(file_info).replace(file_info['etag'].encode('latin-1'),
+                                                                   etag.encode('latin-1'))
+                file_info['encoded_headers_' + coding] = block
+            response_headers = self.build_headers(http_version, 200, connection_socket,
+                                                  b"Content-Length: %d\r\n" % size, block)
+            self.send_content(connection_socket, response_headers, body, f, 0, size)
+        except OSError as e:
+            log.warning("Error serving encoded file: %s", e)
+            connection_socket.keep_alive = False
+        finally:
+            if f is not None:
+                f.close()
+        return True
+
     def generate_response_206(self, http_version, file_idx, file_type, command_parameters, connection_socket):
         #Generate Response and Send
         
         try:
-            file_info = self.content_list[file_idx]
-            file_size = file_info['size']
-            
+            file_info = self.lookup_content(file_idx)
+            body, f, file_size = self.open_content(file_info, ranged=True)
+        except Exception as e:
+            log.warning("Error serving partial content: %s", e)
+            self.generate_response_404(http_version, connection_socket)
+            return
+
+        serve_full = False
+        try:
             # Parse Range header
-            range_header = command_parameters.get('Range', '')
-            if not range_header.startswith('bytes='):
-                self.generate_response_200(http_version, file_idx, file_type, connection_socket)
-                return
-            
-            # Parse range (simple implementation for single range)
-            range_spec = range_header[6:]  # Remove 'bytes='
-            if '-' not in range_spec:
-                self.generate_response_200(http_version, file_idx, file_type, connection_socket)
-                return
-            
-            start_str, end_str = range_spec.split('-', 1)
-            
-            start = int(start_str) if start_str else 0
-            end = int(end_str) if end_str else file_size - 1
-            
-            # Validate range
-            if start >= file_size or end >= file_size or start > end:
+            ranges = self.parse_range_header(command_parameters.get('Range', ''), file_size)
+            if ranges is None:
+                # not a byte range we understand, RFC 7233 says to ignore it;
+                # the 200 goes out below, once this file is closed
+                serve_full = True
+
+            elif not ranges:
                 # Send 416 Range Not Satisfiable
-                response_headers = f"""{http_version} 416 Range Not Satisfiable\r
-Date: {datetime.datetime.now(datetime.UTC).strftime('%a, %d %b %Y %H:%M:%S GMT')}\r
-Server: Simple-File-Server/1.0\r
-Content-Range: bytes */{file_size}\r
-Connection: close\r
-\r
-"""
-                connection_socket.send(response_headers.encode())
-                return
-            
-            # Read partial content
-            with open(file_info['path'], 'rb') as f:
-                f.seek(start)
+                response_headers = self.build_headers(http_version, 416, connection_socket,
+                                                      b"Content-Range: bytes */%d\r\nContent-Length: 0\r\n" % file_size)
+                connection_socket.sendall(response_headers)
+
+            elif len(ranges) > 1:
+                self.send_multipart_ranges(http_version, file_info, file_type, ranges, file_size,
+                                           body, f, connection_socket)
+
+            else:
+                start, end = ranges[0]
                 content_length = end - start + 1
-                file_content = f.read(content_length)
-            
-            response_headers = f"""{http_version} 206 Partial Content\r
-Date: {datetime.datetime.now(datetime.UTC).strftime('%a, %d %b %Y %H:%M:%S GMT')}\r
-Server: Simple-File-Server/1.0\r
-Content-Type: {file_type}\r
-Content-Length: {len(file_content)}\r
-Content-Range: bytes {start}-{end}/{file_size}\r
-Last-Modified: {file_info['modified'].strftime('%a, %d %b %Y %H:%M:%S GMT')}\r
-Accept-Ranges: bytes\r
-Connection: close\r
-\r
-"""
-            
-            # Send headers and content
-            connection_socket.send(response_headers.encode())
-            connection_socket.send(file_content)
-            
-        except Exception as e:
-            print(f"Error serving partial content: {e}")
-            self.generate_response_404(http_version, connection_socket)
+                response_headers = self.build_headers(http_version, 206, connection_socket,
+                                                      b"Content-Range: bytes %d-%d/%d\r\n" % (start, end, file_size),
+                                                      self.file_headers(file_info, content_length))
+
+                # Send headers and content
+                self.send_content(connection_socket, response_headers, body, f, start, content_length)
+        except OSError as e:
+            log.warning("Error serving partial content: %s", e)
+            connection_socket.keep_alive = False
+        finally:
+            if f is not None:
+                f.close()
+
+        if serve_full:
+            self.generate_response_200(http_version, file_idx, file_type, connection_socket)
 
         #return response
 
+    def send_multipart_ranges(self, http_version, file_info, file_type, ranges, file_size, body, f, connection_socket,
+                              send_range=None):
+        # multipart/byteranges: every part gets its own small header and is
+        # streamed straight from the cache, the mapping or sendfile (or by
+        # send_range(start, count) for bodies that aren't one file)
+        boundary = os.urandom(12).hex().encode()
+        part_type = file_type.encode('latin-1')
+        part_headers = []
+        content_length = 0
+        for start, end in ranges:
+            part_header = (b"\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n"
+                           % (boundary, part_type, start, end, file_size))
+            part_headers.append(part_header)
+            content_length += len(part_header) + end - start + 1
+        closing = b"\r\n--%s--\r\n" % boundary
+        content_length += len(closing)
+
+        response_headers = self.build_headers(http_version, 206, connection_socket,
+                                              b"Content-Type: multipart/byteranges; boundary=%s\r\n" % boundary,
+                                              b"Content-Length: %d\r\n" % content_length,
+                                              self.validator_headers(file_info),
+                                              b"Accept-Ranges: bytes\r\n")
+        prefix = response_headers
+        for (start, end), part_header in zip(ranges, part_headers):
+            if send_range is not None:
+                connection_socket.sendall(prefix + part_header)
+                send_range(start, end - start + 1)
+            else:
+                self.send_content(connection_socket, prefix + part_header, body, f, start, end - start + 1)
+            prefix = b''
+        connection_socket.sendall(closing)
+
+    def parse_range_header(self, range_header, file_size):
+        # RFC 7233 byte ranges: "a-b", open-ended "a-" and suffix "-n", comma
+        # separated. Returns None if the header should be ignored, an empty
+        # list if nothing is satisfiable, otherwise sorted (start, end) pairs
+        # with overlapping or nearly adjacent ranges merged.
+        unit, _, range_set = range_header.partition('=')
+        if unit.strip().lower() != 'bytes' or not range_set.strip():
+            return None
+
+        specs = [spec.strip() for spec in range_set.split(',') if spec.strip()]
+        if not specs or len(specs) > MAX_RANGE_COUNT:
+            return None
+
+        ranges = []
+        for spec in specs:
+            start_str, dash, end_str = spec.partition('-')
+            start_str = start_str.strip()
+            end_str = end_str.strip()
+            if not dash or not (start_str.isdigit() or start_str == '') or not (end_str.isdigit() or end_str == ''):
+                return None
+
+            if start_str == '':
+                # suffix range: the last n bytes
+                if end_str == '':
+                    return None
+                suffix_length = int(end_str)
+                if suffix_length == 0 or file_size == 0:
+                    continue
+                ranges.append((max(0, file_size - suffix_length), file_size - 1))
+                continue
+
+            start = int(start_str)
+            if end_str and int(end_str) < start:
+                return None
+            if start >= file_size:
+                continue
+            end = min(int(end_str), file_size - 1) if end_str else file_size - 1
+            ranges.append((start, end))
+
+        ranges.sort()
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1] + 1 + RANGE_COALESCE_GAP:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def open_content(self, file_info, ranged=False):
+        # small files come from the in-memory cache, ranges of large files from
+        # the shared mmap pool and everything else is opened for sendfile.
+        # Returns (body or None, handle to close or None, size) where body is
+        # cached bytes or a memoryview of a mapping.
+        body = self.content_cache.get(file_info['path'], file_info['mtime_ns'], file_info['size'])
+        if body is not None:
+            return body, None, len(body)
+        if ranged and self.mmap_ranges:
+            lease = self.mmap_pool.acquire(file_info['path'], file_info['mtime_ns'])
+            if lease is not None:
+                return lease.view, lease, len(lease.view)
+        f = open(file_info['path'], 'rb')
+        # use the size of the file we opened, not the one recorded at startup
+        return None, f, os.fstat(f.fileno()).st_size
+
+    def send_content(self, connection_socket, response_headers, body, f, offset, count):
+        if isinstance(body, memoryview):
+            # mapped: slice the shared mapping without copying it
+            connection_socket.sendall(response_headers)
+            with body[offset:offset + count] as view:
+                connection_socket.sendall(view)
+            return
+        if body is not None:
+            # cached: headers and body go out in one write
+            connection_socket.sendall(response_headers + body[offset:offset + count])
+            return
+        connection_socket.sendall(response_headers)
+        self.send_file_range(connection_socket, f, offset, count)
+
+    def send_file_range(self, connection_socket, f, offset, count):
+        # send count bytes of an open file starting at offset. sendfile() lets
+        # the kernel copy straight from the page cache to the socket; the
+        # buffered loop is the fallback where that isn't available. Async
+        # connections only queue the range and pick the method when flushing.
+        if isinstance(connection_socket, Async_Connection) or (USE_SENDFILE and hasattr(os, 'sendfile')):
+            try:
+                sent = connection_socket.sendfile(f, offset, count)
+            except (AttributeError, NotImplementedError):
+                sent = 0
+            else:
+                if sent != count:
+                    raise OSError(f"sendfile sent {sent} of {count} bytes")
+                return
+        self.send_file_buffered(connection_socket, f, offset, count)
+
+    def send_file_buffered(self, connection_socket, f, offset, count):
+        f.seek(offset)
+        remaining = count
+        while remaining > 0:
+            data = f.read(min(SEND_CHUNK_SIZE, remaining))
+            if not data:
+                raise OSError(f"File ended {remaining} bytes early")
+            connection_socket.sendall(data)
+            remaining -= len(data)
+
     def generate_content_type(self, file_type):
         #Generate Headers
         return f"Content-Type: {file_type}\r\n"
 
     def eval_commands(self, commands):
+        # header lines (bytes) to a dict; names are case-insensitive on the
+        # wire so they are normalised to Title-Case ("if-range" -> "If-Range")
         command_dict = {}
         for item in commands[1:]:
-            item = item.strip()
-            if ':' in item and item:
-                try:
-                    key, value = item.split(":", 1)
-                    command_dict[key.strip()] = value.strip()
-                except ValueError:
-                    print(f"Invalid command format: {item}")
-                    continue
-            # splitted_item = item.split(":")
-            # command_dict[splitted_item[0]] = splitted_item[1].strip()
+            key, colon, value = item.partition(b":")
+            if not colon:
+                if item.strip():
+                    log.debug("Invalid command format: %s", item)
+                continue
+            command_dict[key.strip().decode('latin-1').title()] = value.strip().decode('latin-1')
         return command_dict
 
 if __name__ == "__main__":
-    Vod_Server(int(sys.argv[1]))
+    # usage: python vodserver.py <port> [thread|select|asyncio] [workers] [processes] [origin url]
+    mode = sys.argv[2] if len(sys.argv) > 2 else CONCURRENCY_MODE
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else WORKER_COUNT
+    processes = int(sys.argv[4]) if len(sys.argv) > 4 else PREFORK_PROCESSES
+    origin = sys.argv[5] if len(sys.argv) > 5 else ORIGIN
+    Vod_Server(int(sys.argv[1]), mode, workers, processes=processes, origin=origin)
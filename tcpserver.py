@@ -1,17 +1,196 @@
 import socket, sys
+import os
 import json
 import time
 import threading
+import queue
 
 import struct # NEW: for packing and unpacking binary data
 
 import random  # NEW: for simulating packet loss
+import collections
 
-BUFSIZE = 10202  # size of receiving buffer
+BUFSIZE = 10204  # size of receiving buffer: a packet plus a 32-bit index
 PKTSIZE = 10200  # number of bytes in a packet
-WINDOW_SIZE = 16
+WINDOW_SIZE = 16  # initial congestion window in packets
+MAX_WINDOW = 512  # upper bound on the congestion window in packets
 IDX_LENGTH = 2 # 2 bytes of packet index
-TIMEOUT = 0.5   # timeout time
+SEQ16 = struct.Struct('!H')  # original packet index: files up to 65,535 packets (~650 MB)
+SEQ32 = struct.Struct('!I')  # wide index, offered as "SEQ32" in SYNACK and accepted with "ACK;SEQ32"
+SEQ16_MAX_PACKETS = 0xFFFF  # largest transfer to a 16-bit receiver, 0xFFFF stays free as the SACK no-echo value
+TIMEOUT = 0.5   # timeout time, also the retransmission timeout until an RTT has been measured
+MIN_RTO = 0.02  # lower bound on the adaptive retransmission timeout
+MAX_RTO = 2.0  # upper bound, exponential backoff stops here
+DUPACK_THRESHOLD = 3  # packets acked past a hole before it is retransmitted without waiting for the timeout
+ACK_EVERY = 8  # SACK receivers acknowledge every N packets...
+ACK_DELAY = 0.005  # ...or this many seconds after the first unacknowledged one
+SACK_BLOCKS = 32  # received ranges above the cumulative ACK carried per SACK
+DROP_PROBABILITY = 0.1  # simulated loss in the listener
+CONGESTION_CONTROL = "reno"  # "reno" (slow start + AIMD) or "pacing" (delay-based, paced sends); config key "congestion_control"
+
+
+class Rtt_Estimator():
+    # retransmission timeout from measured round trips (Jacobson/Karels, RFC
+    # 6298): smoothed RTT plus four times its mean deviation. Samples only
+    # come from packets sent once (Karn's rule, enforced by the caller), and
+    # every timeout doubles the RTO until a fresh sample arrives.
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.srtt = None
+        self.rttvar = None
+        self.rto = TIMEOUT
+
+    def sample(self, rtt):
+        with self.lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+                self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+            # a new sample also ends any backoff
+            self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + self.K * self.rttvar))
+
+    def backoff(self):
+        with self.lock:
+            self.rto = min(MAX_RTO, self.rto * 2)
+
+
+class Reno_Controller():
+    # TCP Reno style congestion control: the window doubles every round trip
+    # in slow start, then grows by one packet per round trip (additive
+    # increase). A loss halves it (multiplicative decrease), a timeout drops
+    # it back to one packet. Only one reduction per window of data.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cwnd = float(WINDOW_SIZE)
+        self.ssthresh = float(MAX_WINDOW)
+        self.recover = -1  # highest packet sent when the window was last cut
+
+    def window(self):
+        # packets that may be outstanding past the window start
+        return max(1, int(self.cwnd))
+
+    def send_delay(self):
+        # Reno is ACK-clocked, packets go out as soon as the window allows
+        return 0.0
+
+    def on_ack(self, acked, rtt, now):
+        with self.lock:
+            for _ in range(acked):
+                if self.cwnd < self.ssthresh:
+                    self.cwnd += 1
+                else:
+                    self.cwnd += 1 / self.cwnd
+            self.cwnd = min(self.cwnd, MAX_WINDOW)
+
+    def on_loss(self, idx, highest_sent):
+        # duplicate ACKs or a RETX request: fast retransmit, halve the window
+        with self.lock:
+            if idx <= self.recover:
+                return
+            self.recover = highest_sent
+            self.ssthresh = max(self.cwnd / 2, 2.0)
+            self.cwnd = self.ssthresh
+
+    def on_timeout(self, idx, highest_sent):
+        with self.lock:
+            if idx <= self.recover:
+                return
+            self.recover = highest_sent
+            self.ssthresh = max(self.cwnd / 2, 2.0)
+            self.cwnd = 1.0
+
+
+class Pacing_Controller():
+    # delay-based control in the style of BBR: it measures the delivery rate
+    # (packets acked per interval) and the minimum round trip time, paces
+    # sends at a gain times the best recent delivery rate and sizes the window
+    # to about two bandwidth-delay products. Random loss doesn't shrink the
+    # window, queueing delay does (it lowers the measured rate).
+    STARTUP_GAIN = 2.885
+    PROBE_GAINS = (1.25, 0.75, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0)
+    BANDWIDTH_SAMPLES = 10  # intervals the delivery rate max-filter covers
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.min_rtt = None
+        self.bandwidth = 0.0  # packets per second
+        self.samples = collections.deque(maxlen=self.BANDWIDTH_SAMPLES)
+        self.interval_start = None
+        self.interval_acked = 0
+        self.state = "startup"
+        self.pacing_gain = self.STARTUP_GAIN
+        self.full_bandwidth = 0.0
+        self.full_bandwidth_count = 0
+        self.cycle = 0
+
+    def window(self):
+        if self.min_rtt is None or not self.bandwidth:
+            return WINDOW_SIZE
+        bdp = self.bandwidth * self.min_rtt
+        return max(4, min(MAX_WINDOW, int(2 * bdp) + 1))
+
+    def send_delay(self):
+        # seconds between packets at the current pacing rate
+        if not self.bandwidth:
+            return 0.0
+        return 1.0 / (self.pacing_gain * self.bandwidth)
+
+    def on_ack(self, acked, rtt, now):
+        with self.lock:
+            if rtt is not None and (self.min_rtt is None or rtt < self.min_rtt):
+                self.min_rtt = rtt
+            if self.interval_start is None:
+                self.interval_start = now
+            self.interval_acked += acked
+            # one delivery rate sample per round trip (10 ms until one is measured)
+            elapsed = now - self.interval_start
+            if elapsed < max(self.min_rtt or 0.01, 0.001):
+                return
+            self.samples.append(self.interval_acked / elapsed)
+            self.bandwidth = max(self.samples)
+            self.interval_start = now
+            self.interval_acked = 0
+            self.next_phase()
+
+    def next_phase(self):
+        # caller holds the lock
+        if self.state == "startup":
+            # leave startup once the rate stopped growing by 25% for three rounds
+            if self.bandwidth >= self.full_bandwidth * 1.25:
+                self.full_bandwidth = self.bandwidth
+                self.full_bandwidth_count = 0
+            else:
+                self.full_bandwidth_count += 1
+                if self.full_bandwidth_count >= 3:
+                    # drain the queue startup built up
+                    self.state = "drain"
+                    self.pacing_gain = 1 / self.STARTUP_GAIN
+        elif self.state == "drain":
+            self.state = "probe_bw"
+            self.cycle = 0
+            self.pacing_gain = self.PROBE_GAINS[0]
+        else:
+            self.cycle = (self.cycle + 1) % len(self.PROBE_GAINS)
+            self.pacing_gain = self.PROBE_GAINS[self.cycle]
+
+    def on_loss(self, idx, highest_sent):
+        # loss alone isn't treated as congestion
+        pass
+
+    def on_timeout(self, idx, highest_sent):
+        pass
+
+
+CONGESTION_CONTROLLERS = {
+    "reno": Reno_Controller,
+    "pacing": Pacing_Controller,
+}
 
 class Server():
     def __init__(self, config_file):
@@ -25,12 +204,16 @@ class Server():
         self.peer_num = config['peers']
         self.content_info = config['content_info']
         self.peer_info = config['peer_info']
+        self.congestion_control = config.get('congestion_control', CONGESTION_CONTROL)
+        if self.congestion_control not in CONGESTION_CONTROLLERS:
+            raise ValueError(f"Unknown congestion control: {self.congestion_control}")
 
         print("Server hostname: ", self.hostname)
         print("Server port: ", self.port)
         print("Peer number: ", self.peer_num)
         print("Content info: ", self.content_info)
         print("Peer info: ", self.peer_info)
+        print("Congestion control: ", self.congestion_control)
 
         # establish a socket according to the information
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) #NOTE THAT THE SOCK_DGRAM will ensure your socket is UDP
@@ -46,7 +229,7 @@ class Server():
         # Active transmissions tracking
         self.active_transmissions = {}
         # message routing
-        self.pending_responses = {}  # addr -> {message_type: queue}
+        self.pending_responses = {}  # (normalized addr, message_type) -> queue
         self.response_lock = threading.Lock()
         
         self.cli()
@@ -61,32 +244,35 @@ class Server():
                 return peer
         return None
 
+    def response_queue(self, addr, message_type):
+        # one queue per (normalized address, message type), created on first use
+        key = (self.normalize_address(addr), message_type)
+        with self.response_lock:
+            if key not in self.pending_responses:
+                self.pending_responses[key] = queue.Queue()
+            return self.pending_responses[key]
+
     def wait_for_response(self, expected_addr, message_type="default", timeout=2.0):
-        # wait for response from specific address and message type
-        start_time = time.time()
-        expected_normalized = self.normalize_address(expected_addr)
-        
-        while time.time() - start_time < timeout:
-            with self.response_lock:
-                # Check both normalized and original addresses
-                for addr_key in self.pending_responses:
-                    if (self.normalize_address(addr_key) == expected_normalized and 
-                        message_type in self.pending_responses[addr_key] and 
-                        self.pending_responses[addr_key][message_type]):
-                        return self.pending_responses[addr_key][message_type].pop(0)
-            #time.sleep(0.01)
-        
-        raise socket.timeout(f"No response from {expected_addr} for type {message_type}")
-        
+        # wait for response from specific address and message type; blocks on
+        # that pair's queue, so the waiter sleeps until route_message wakes it
+        try:
+            return self.response_queue(expected_addr, message_type).get(timeout=timeout)
+        except queue.Empty:
+            raise socket.timeout(f"No response from {expected_addr} for type {message_type}")
+
+    def discard_responses(self, addr, message_type):
+        # drop whatever is still queued for this pair, e.g. late ACKs of the
+        # previous transfer with the same peer, so a new transfer starts clean
+        pending = self.response_queue(addr, message_type)
+        while True:
+            try:
+                pending.get_nowait()
+            except queue.Empty:
+                return
 
     def queue_message(self, data, addr, message_type="default"):
         # Queue message for a specific address and type
-        with self.response_lock:
-            if addr not in self.pending_responses:
-                self.pending_responses[addr] = {}
-            if message_type not in self.pending_responses[addr]:
-                self.pending_responses[addr][message_type] = []
-            self.pending_responses[addr][message_type].append((data, addr))
+        self.response_queue(addr, message_type).put((data, addr))
 
     def route_message(self, data, addr):
         print(f"Routing message {len(data)} bytes from {addr}")
@@ -105,17 +291,18 @@ class Server():
             # Queue for handshake
             self.queue_message(data, addr, "handshake")
             
-        elif data == b"ACK":
-            # Queue for handshake ACK
+        elif data == b"ACK" or data.startswith(b"ACK;"):
+            # Queue for handshake ACK, "ACK;<options>" accepts options offered in SYNACK
             self.queue_message(data, addr, "handshake")
             
-        elif data.startswith(b"ACK:"):
+        elif data.startswith(b"ACK:") or data.startswith(b"SACK:"):
             # Queue for file transfer ACK
             self.queue_message(data, addr, "file_ack")
             
         elif data.startswith(b"RETX:"):
-            # Queue for retransmission request
-            self.queue_message(data, addr, "retx")
+            # Retransmission requests go to the sender's ACK queue too, so
+            # ack_thread waits on a single queue for both
+            self.queue_message(data, addr, "file_ack")
             
         elif data.startswith(b"ERROR:"):
             # Queue for error messages
@@ -146,6 +333,33 @@ class Server():
         # check if two addresses go to the same endpoint
         return self.normalize_address(addr1) == self.normalize_address(addr2)
 
+    def sack_message(self, received_packets, cumulative, highest, echo, seq=SEQ16):
+        # SACK:<cumulative><echo><start><end>... every packet below the
+        # cumulative index has arrived, plus the [start, end) ranges above it.
+        # echo is the packet whose arrival triggered this SACK, the sender
+        # times its round trip from that one. All fields are packed with the
+        # transfer's index format seq.
+        blocks = []
+        i = cumulative
+        while i <= highest and len(blocks) < SACK_BLOCKS:
+            if i in received_packets:
+                start = i
+                while i in received_packets:
+                    i += 1
+                blocks.append(seq.pack(start) + seq.pack(i))
+            else:
+                i += 1
+        return b"SACK:" + seq.pack(cumulative) + seq.pack(echo) + b"".join(blocks)
+
+    def parse_sack(self, data, seq=SEQ16):
+        # returns (cumulative, echo, [(start, end), ...])
+        fields = [seq.unpack_from(data, offset)[0] for offset in range(5, len(data) - seq.size + 1, seq.size)]
+        return fields[0], fields[1], list(zip(fields[2::2], fields[3::2]))
+
+    def no_echo(self, seq):
+        # echo value of a SACK not triggered by a data packet, never a valid index
+        return (1 << (8 * seq.size)) - 1
+
     def load_file(self, file_name):
         # find which server has the file
         peer = self.find_file(file_name)
@@ -166,6 +380,10 @@ class Server():
         handshake_attempts = 0
         max_attempts = 3
         
+        # a SYNACK retry from the previous download from this peer would be
+        # taken for this one's
+        self.discard_responses(normalized_peer_addr, "handshake")
+
         while not connect_flag and handshake_attempts < max_attempts:
             try:
                 # Send file request (SYN)
@@ -183,13 +401,21 @@ class Server():
                 
                 if self.addresses_match(addr, peer_addr):
                     if response.startswith(b"SYNACK:"):
-                        packet_num = int(response.decode().split(":")[1])
-                        print(f"Received packet count: {packet_num}")
+                        # SYNACK:<packets>[:SACK][:SEQ32], older senders only send the count
+                        fields = response.decode().split(":")
+                        packet_num = int(fields[1])
+                        use_sack = "SACK" in fields[2:]
+                        seq = SEQ32 if "SEQ32" in fields[2:] else SEQ16
+                        handshake_ack = b"ACK;SEQ32" if seq is SEQ32 else b"ACK"
+                        print(f"Received packet count: {packet_num}, SACK: {use_sack}, {8 * seq.size}-bit index")
+                        # the sender stopped the previous transfer before this
+                        # SYNACK, its late packets are all queued by now
+                        self.discard_responses(normalized_peer_addr, "file_data")
                         
                         # Send ACK
                         print(f"Sending ACK to {normalized_peer_addr}")
                         with self.socket_lock:
-                            self.server_socket.sendto(b"ACK", normalized_peer_addr)
+                            self.server_socket.sendto(handshake_ack, normalized_peer_addr)
                         
                         connect_flag = True
                     elif response.startswith(b"ERROR:"):
@@ -214,35 +440,87 @@ class Server():
             print("Failed to establish connection")
             return
         
-        # the receiver keeps a record for which part has been acked
-        received_packets = {}
+        # the receiver keeps a record for which part has been acked; packets
+        # are written straight to a partial file at their offset, so memory
+        # doesn't grow with the file
+        received_packets = set()
+        partial_name = file_name + ".part"
+        partial_file = open(partial_name, 'wb')
         expected_packets = packet_num
         received_count = 0
+        # SACK state: all packets below cumulative have arrived
+        cumulative = 0
+        highest = -1
+        unacked = 0  # packets received since the last SACK
+        ack_deadline = None
+        no_echo = self.no_echo(seq)
+        last_arrival = no_echo
+        
+        def send_sack(echo=no_echo):
+            nonlocal unacked, ack_deadline
+            with self.socket_lock:
+                self.server_socket.sendto(self.sack_message(received_packets, cumulative, highest, echo, seq),
+                                          normalized_peer_addr)
+            unacked = 0
+            ack_deadline = None
         
         # start receiving file
         print("Starting file reception...")
         
         while received_count < expected_packets:
             try:
-                # Wait for file data packets
-                data, addr = self.wait_for_response(normalized_peer_addr, "file_data", timeout=1.0)
+                # Wait for file data packets, or until a delayed SACK is due
+                timeout = 1.0 if ack_deadline is None else max(0.0, ack_deadline - time.time())
+                data, addr = self.wait_for_response(normalized_peer_addr, "file_data", timeout=timeout)
                 
-                if self.addresses_match(addr, peer_addr) and len(data) >= IDX_LENGTH:
+                if self.addresses_match(addr, peer_addr) and len(data) >= seq.size:
                     # Extract packet index
-                    packet_idx = struct.unpack('!H', data[:IDX_LENGTH])[0]
-                    packet_data = data[IDX_LENGTH:]
+                    packet_idx = seq.unpack_from(data)[0]
+                    packet_data = data[seq.size:]
+                    if packet_idx >= expected_packets:
+                        continue
                     
-                    if packet_idx not in received_packets:
-                        received_packets[packet_idx] = packet_data
+                    duplicate = packet_idx in received_packets
+                    if not duplicate:
+                        os.pwrite(partial_file.fileno(), packet_data, packet_idx * PKTSIZE)
+                        received_packets.add(packet_idx)
                         received_count += 1
                         print(f"Received packet {received_count}/{expected_packets}")
                     
-                    # Send ACK for this packet
-                    ack_msg = struct.pack('!H', packet_idx)
-                    with self.socket_lock:
-                        self.server_socket.sendto(b"ACK:" + ack_msg, normalized_peer_addr)
+                    if not use_sack:
+                        # Send ACK for this packet
+                        ack_msg = struct.pack('!H', packet_idx)
+                        with self.socket_lock:
+                            self.server_socket.sendto(b"ACK:" + ack_msg, normalized_peer_addr)
+                        continue
+                    
+                    # A new hole, a filled hole or a duplicate is reported at
+                    # once so the sender can react; in-order data is acked in
+                    # batches of ACK_EVERY or after ACK_DELAY
+                    urgent = duplicate or packet_idx > highest + 1 or packet_idx < highest
+                    highest = max(highest, packet_idx)
+                    while cumulative in received_packets:
+                        cumulative += 1
+                    unacked += 1
+                    last_arrival = packet_idx
+                    if urgent or unacked >= ACK_EVERY or received_count == expected_packets:
+                        send_sack(packet_idx)
+                    elif ack_deadline is None:
+                        ack_deadline = time.time() + ACK_DELAY
                         
             except socket.timeout:
+                if received_count == 0:
+                    # nothing yet: our handshake ACK may have been lost and the
+                    # sender is still waiting for it
+                    with self.socket_lock:
+                        self.server_socket.sendto(handshake_ack, normalized_peer_addr)
+                
+                if use_sack:
+                    # delayed SACK due, or nothing heard for a while: either
+                    # way the sender learns what is missing from the SACK
+                    send_sack(last_arrival if ack_deadline is not None else no_echo)
+                    continue
+                
                 # request missing packets
                 missing = []
                 for i in range(expected_packets):
@@ -256,29 +534,22 @@ class Server():
                             self.server_socket.sendto(b"RETX:" + retransmit_req, normalized_peer_addr)
         
         # transmission complete, close socket
+        if use_sack:
+            # the final SACK may be dropped too, repeat it
+            for _ in range(2):
+                send_sack()
 
-        # Reconstruct file
-        file_data = b""
-        for i in range(expected_packets):
-            if i in received_packets:
-                file_data += received_packets[i]
-        
-        # write the file
-        with open(file_name, 'wb') as f:
-            f.write(file_data)
+        # every packet is in place, the partial file becomes the file
+        partial_file.close()
+        os.replace(partial_name, file_name)
         print(f"\nFile {file_name} downloaded successfully")
 
     def read_file(self, file_name):
-        #You can write a function that takes the file to be transmitted and converts into chunks of packet_size
-        with open(file_name, 'rb') as f:
-            file_data = f.read()
-           
-        transmit_file = []
-        for i in range(0, len(file_data), PKTSIZE):
-            chunk = file_data[i:i+PKTSIZE]
-            transmit_file.append(chunk)
-            
-        return transmit_file
+        # open the file to be transmitted, packets of PKTSIZE are read from it
+        # on demand so large files aren't held in memory; returns (file, packet count)
+        transmit_file = open(file_name, 'rb')
+        file_size = os.fstat(transmit_file.fileno()).st_size
+        return transmit_file, (file_size + PKTSIZE - 1) // PKTSIZE
 
     def transmit(self, file_name, addr):
         # create a udp socket for transmission
@@ -286,43 +557,70 @@ class Server():
         print(f"Starting transmission of {file_name} to {addr}")
         
         # divide the file into several parts
-        transmit_file = self.read_file(file_name)
+        transmit_file, packet_num = self.read_file(file_name)
         
         # use socket to send packet number to the receiver
-        packet_num = len(transmit_file)
         print(f"File has {packet_num} packets, sending SYNACK to {addr}")
         
+        # advertise SACK and 32-bit packet indices, older receivers only read
+        # the packet count
+        synack = ("SYNACK:" + str(packet_num) + ":SACK:SEQ32").encode()
+        client_normalized_addr = self.normalize_address(addr)
+        # the receiver downloads one file at a time, so its new request ends
+        # any transfer still running to it (the final SACKs may have been
+        # lost). It is stopped before the SYNACK goes out, so none of its
+        # packets can follow it. Only then are the queues cleared of the late
+        # SACKs, whose cumulative index would ack this file
+        previous = self.active_transmissions.get(addr)
+        if previous is not None:
+            previous['active'] = False
+            previous['wakeup'].set()
+            previous['done'].wait()
+        self.discard_responses(client_normalized_addr, "handshake")
+        self.discard_responses(client_normalized_addr, "file_ack")
         with self.socket_lock:
-            self.server_socket.sendto(("SYNACK:" + str(packet_num)).encode(), addr)
+            self.server_socket.sendto(synack, addr)
         
         # wait for ACK with correct message type
         ack_received = False
-        client_normalized_addr = self.normalize_address(addr)
         
         for attempt in range(3):
             try:
                 response, client_addr = self.wait_for_response(client_normalized_addr, "handshake", timeout=2.0)
                 print(f"Received handshake response: {response} from {client_addr}")
                 
-                if response == b"ACK" and self.addresses_match(client_addr, addr):
+                if (response == b"ACK" or response.startswith(b"ACK;")) and self.addresses_match(client_addr, addr):
                     ack_received = True
-                    print("ACK received from client")
+                    # a plain ACK comes from a receiver that only knows 16-bit indices
+                    seq = SEQ32 if "SEQ32" in response.decode().split(";")[1:] else SEQ16
+                    print(f"ACK received from client, {8 * seq.size}-bit index")
                     break
                     
             except socket.timeout:
                 print(f"Waiting for ACK, attempt {attempt + 1}")
                 # Resend SYNACK
                 with self.socket_lock:
-                    self.server_socket.sendto(("SYNACK:" + str(packet_num)).encode(), addr)
+                    self.server_socket.sendto(synack, addr)
         
         if not ack_received:
             print("Client ACK timeout after retries")
+            transmit_file.close()
+            return
+        
+        if seq is SEQ16 and packet_num > SEQ16_MAX_PACKETS:
+            # the index would wrap and corrupt the file on the other side
+            print(f"File has too many packets for a 16-bit receiver ({packet_num})")
+            with self.socket_lock:
+                self.server_socket.sendto(b"ERROR:File too large for this client", addr)
+            transmit_file.close()
             return
         
         # use a time-out array to record which file is time-out and need to be transmitted again
         # -1 indicates received, 0 indicates not transmitted, positive numbers means the time of transmission
         acked = [False] * packet_num
         last_sent = [-1] * packet_num  # Timestamp of last transmission
+        resend = [False] * packet_num  # reported lost, sent again without waiting for the timeout
+        transmissions = [0] * packet_num  # times each packet was sent
         
         # Create transmission state
         tx_state = {
@@ -330,75 +628,167 @@ class Server():
             'window_start': 0,
             'acked': acked,
             'last_sent': last_sent,
+            'resend': resend,
             'transmit_file': transmit_file,
             'addr': addr,
-            'packet_num': packet_num
+            'packet_num': packet_num,
+            'transmissions': transmissions,
+            'highest_sent': -1,
+            'controller': CONGESTION_CONTROLLERS[self.congestion_control](),
+            'rtt': Rtt_Estimator(),
+            'wakeup': threading.Event(),  # set by ack_thread when there may be something to send
+            'done': threading.Event()  # set once both threads have stopped
         }
+        controller = tx_state['controller']
+        rtt_estimator = tx_state['rtt']
         
         self.active_transmissions[addr] = tx_state
         
         def transmit_thread():
             #Takes the transmit window and transmits every packet that is allowed
+            next_send = 0.0  # earliest time the pacing rate allows the next packet
             while tx_state['active'] and tx_state['window_start'] < packet_num:
+                tx_state['wakeup'].clear()
                 current_time = time.time()
+                rto = rtt_estimator.rto
+                next_timeout = current_time + rto
+                backed_off = False
                 
-                # Send packets in window
-                for i in range(tx_state['window_start'], 
-                             min(tx_state['window_start'] + WINDOW_SIZE, packet_num)):
+                # Send packets in the congestion window, it is re-read for
+                # every packet since ACKs and timeouts resize it
+                i = tx_state['window_start']
+                while i < min(tx_state['window_start'] + controller.window(), packet_num):
                     
-                    if (not tx_state['acked'][i] and 
-                        (tx_state['last_sent'][i] == -1 or 
-                         current_time - tx_state['last_sent'][i] > TIMEOUT)):
+                    if tx_state['acked'][i]:
+                        i += 1
+                        continue
+                    
+                    timed_out = (tx_state['last_sent'][i] != -1 and 
+                                 current_time - tx_state['last_sent'][i] > rto)
+                    if tx_state['last_sent'][i] == -1 or tx_state['resend'][i] or timed_out:
+                        if timed_out:
+                            # one backoff per timer expiry, however many packets it covers
+                            if not backed_off:
+                                rtt_estimator.backoff()
+                                backed_off = True
+                            controller.on_timeout(i, tx_state['highest_sent'])
+                            if i >= tx_state['window_start'] + controller.window():
+                                break
+                        
+                        # Pace sends when the controller asks for it
+                        if next_send > current_time:
+                            time.sleep(next_send - current_time)
+                            current_time = time.time()
+                        next_send = max(next_send, current_time) + controller.send_delay()
                         
                         # Prepare packet with index
-                        packet_data = struct.pack('!H', i) + tx_state['transmit_file'][i]
+                        packet_data = seq.pack(i) + os.pread(transmit_file.fileno(), PKTSIZE, i * PKTSIZE)
+                        
+                        # recorded before sending, the ACK can beat the return
+                        # from sendto and must find this copy already counted
+                        tx_state['last_sent'][i] = current_time
+                        tx_state['resend'][i] = False
+                        tx_state['transmissions'][i] += 1
+                        tx_state['highest_sent'] = max(tx_state['highest_sent'], i)
                         
                         with self.socket_lock:
                             self.server_socket.sendto(packet_data, addr)
-                        
-                        tx_state['last_sent'][i] = current_time
                         print(f"Sent packet {i} to {addr}")
+                    
+                    else:
+                        next_timeout = min(next_timeout, tx_state['last_sent'][i] + rto)
+                    i += 1
                 
-                # time.sleep(0.01)  # Small delay to prevent overwhelming
+                # Sleep until an ACK moves the window or a RETX arrives, or the
+                # earliest outstanding packet times out
+                tx_state['wakeup'].wait(max(0.0, next_timeout - time.time()))
             
             print(f"Transmission to {addr} completed")
         
+        def acknowledge(indices, highest_acked, echo):
+            # mark packets received, feed the RTT estimator and the congestion
+            # controller, slide the window and retransmit what the ACK shows lost.
+            # echo is the packet that triggered the ACK, the only one timed
+            now = time.time()
+            newly_acked = 0
+            rtt = None
+            for idx in indices:
+                if tx_state['acked'][idx]:
+                    continue
+                tx_state['acked'][idx] = True
+                newly_acked += 1
+                # RTT sample only from packets sent once, a retransmitted
+                # packet's ACK could belong to either copy. last_sent is the
+                # send time even while a resend is pending
+                if idx == echo and tx_state['transmissions'][idx] == 1:
+                    rtt = now - tx_state['last_sent'][idx]
+            if not newly_acked:
+                return
+            if rtt is not None:
+                rtt_estimator.sample(rtt)
+            controller.on_ack(newly_acked, rtt, now)
+            
+            # Advance window
+            while (tx_state['window_start'] < packet_num and 
+                   tx_state['acked'][tx_state['window_start']]):
+                tx_state['window_start'] += 1
+            
+            # Packets acked well past a hole mean it was lost: retransmit it
+            # now rather than at the timeout
+            for hole in range(tx_state['window_start'], highest_acked - DUPACK_THRESHOLD + 1):
+                if (not tx_state['acked'][hole] and tx_state['transmissions'][hole] == 1 and 
+                        not tx_state['resend'][hole]):
+                    tx_state['resend'][hole] = True
+                    controller.on_loss(hole, tx_state['highest_sent'])
+            tx_state['wakeup'].set()
+        
         def ack_thread():
             #Receives acknowledgement and updates the transmit window with sendable packets
             while tx_state['active'] and tx_state['window_start'] < packet_num:
                 try:
-                    # Use message routing for ACKs with correct types
+                    # ACKs and retransmission requests share one queue
                     try:
-                        data, client_addr = self.wait_for_response(client_normalized_addr, "file_ack", timeout=0.05)
+                        data, client_addr = self.wait_for_response(client_normalized_addr, "file_ack", timeout=TIMEOUT)
                     except socket.timeout:
-                        # Also check for retransmission requests
-                        try:
-                            data, client_addr = self.wait_for_response(client_normalized_addr, "retx", timeout=0.05)
-                        except socket.timeout:
-                            continue
+                        continue
                     
                     if self.addresses_match(client_addr, addr):
+                        # nothing past the highest packet sent can have arrived,
+                        # an index beyond it belongs to some other transfer
+                        sent_end = tx_state['highest_sent'] + 1
                         if data.startswith(b"ACK:") and len(data) >= 4:
-                            # Regular ACK
+                            # Regular ACK for one packet
                             ack_idx = struct.unpack('!H', data[4:6])[0]
-                            if 0 <= ack_idx < packet_num:
-                                tx_state['acked'][ack_idx] = True
-                                
-                                # Advance window
-                                while (tx_state['window_start'] < packet_num and 
-                                       tx_state['acked'][tx_state['window_start']]):
-                                    tx_state['window_start'] += 1
+                            if 0 <= ack_idx < sent_end:
+                                acknowledge([ack_idx], ack_idx, ack_idx)
+                        
+                        elif data.startswith(b"SACK:") and len(data) >= 9:
+                            # Cumulative ACK plus received ranges above it
+                            cumulative, echo, blocks = self.parse_sack(data, seq)
+                            if cumulative > sent_end:
+                                print(f"Ignoring stale SACK from {client_addr} (cumulative {cumulative}, sent {sent_end})")
+                                continue
+                            indices = list(range(tx_state['window_start'], cumulative))
+                            highest = cumulative - 1
+                            for block_start, block_end in blocks:
+                                block_end = min(block_end, sent_end)
+                                indices.extend(range(block_start, block_end))
+                                highest = max(highest, block_end - 1)
+                            acknowledge(indices, highest, echo)
                         
                         elif data.startswith(b"RETX:") and len(data) >= 6:
                             # Retransmission request
                             retx_idx = struct.unpack('!H', data[5:7])[0]
-                            if 0 <= retx_idx < packet_num:
-                                tx_state['last_sent'][retx_idx] = -1  # Force retransmission
+                            if 0 <= retx_idx < sent_end and not tx_state['acked'][retx_idx]:
+                                tx_state['resend'][retx_idx] = True  # Force retransmission
+                                controller.on_loss(retx_idx, tx_state['highest_sent'])
+                                tx_state['wakeup'].set()
                                 
                 except Exception as e:
                     print("ACK thread error: {}".format(e))
             
             tx_state['active'] = False
+            tx_state['wakeup'].set()
         
         #Create TX and RX threads and start doing it
         tx_thread = threading.Thread(target=transmit_thread)
@@ -410,9 +800,11 @@ class Server():
         #When done transmitting, close the threads.
         tx_thread.join()
         ack_thread_obj.join()
+        transmit_file.close()
         
-        if addr in self.active_transmissions:
+        if self.active_transmissions.get(addr) is tx_state:
             del self.active_transmissions[addr]
+        tx_state['done'].set()
 
     def listener(self): # listen to the socket to see if there's any transmission request
         print("Listener thread started on {}:{}".format(self.hostname, self.port))
@@ -421,7 +813,7 @@ class Server():
         while self.remain_threads:
             try:
                 data, addr = self.server_socket.recvfrom(BUFSIZE)
-                if random.random() < 0.1: # 10% probability to drop the packet as simulation
+                if random.random() < DROP_PROBABILITY: # drop the packet as simulation
                     print(f"DROPPED: Packet dropped from {addr}!")
                     pass
                 else: